@@ -9,6 +9,7 @@ cell groups and connections into anatomical and physiological csv files
 for CxSystem2 package.
 
 Classes
+    ConfigSections: Anatomy or physiology config parsed into sections
     Config: This class contains general utility methods. 
     Area:   This class contains area-level data and methods
     Group:  Neuron group level data and methods
@@ -16,11 +17,14 @@ Classes
 '''
 
 import numpy as np
-from matplotlib import pyplot as plt
 import os
+import weakref
 import pandas as pd
 
-from cxsystem2.core.tools import  read_config_file
+# matplotlib and cxsystem2 (which imports brian2) are loaded on first use
+from lazy_import import LazyImport
+plt = LazyImport('matplotlib.pyplot')
+read_config_file = LazyImport('cxsystem2.core.tools', 'read_config_file')
 
 import pdb
 
@@ -56,25 +60,186 @@ INPUT_LAYER_IDX = 0
 INPUT_LAYER_TARGET_LAYER = 'L4C'
 INPUT_CONNECTION_PROBABILITY = 1.0
 
+# Anatomy columns held as categoricals. Other columns are nullable Int64 or Float64 if all values are numbers,
+# otherwise object, eg '--' and '[4->1]'. CxSystem2 form is restored when sections are spliced back for writing.
+CATEGORICAL_COLUMNS = ['row_type', 'neuron_type', 'receptor', 'syn_type']
+
 
 ##############################################
 ################# MAIN CODE ##################
 ##############################################
 
 
+class ConfigSections:
+
+    '''
+    Anatomy or physiology config df parsed once into sections.
+
+    Anatomy sections are named by row type (params, IN, G, S). Each has a header row (row_type,...) followed
+    by data rows. Physiology sections are named by their marker text, eg '### NEURON GROUP PARAMETERS ###'
+    gives 'NEURON GROUP PARAMETERS', and contain the rows until the next marker.
+
+    Offsets are row positions in config_df: header is the header/marker row, start:stop the data rows.
+    Anatomy frames are typed, see CATEGORICAL_COLUMNS. The config df is held by a weak reference, so that
+    cached sections do not keep it alive, see Config.get_config_sections.
+    '''
+
+    def __init__(self, config_df):
+        self._config_df_ref = weakref.ref(config_df)
+        self.n_columns = config_df.shape[1]
+        first_column = config_df.iloc[:,0].values
+        if 'row_type' in first_column:
+            self.config_type = 'anatomy'
+            self.offsets = self._parse_anatomy(first_column)
+        else:
+            self.config_type = 'physiology'
+            self.offsets = self._parse_physiology(first_column)
+        self._frames = {}
+
+    @staticmethod
+    def _parse_anatomy(first_column):
+        # One pass over the row types. Data rows of a section follow its header row until the row type changes.
+        offsets = {}
+        header, current_type = None, None
+        for row, row_type in enumerate(first_column):
+            if row_type == 'row_type':
+                header, current_type = row, None
+            elif isinstance(row_type, str) and header is not None:
+                if current_type is None:
+                    current_type = row_type
+                    offsets[row_type] = {'header' : header, 'start' : row, 'stop' : row + 1}
+                elif row_type == current_type:
+                    offsets[row_type]['stop'] = row + 1
+            else:
+                header, current_type = None, None
+        return offsets
+
+    @staticmethod
+    def _parse_physiology(first_column):
+        offsets = {}
+        current_section = None
+        for row, variable in enumerate(first_column):
+            if isinstance(variable, str) and variable.startswith('###'):
+                current_section = variable.strip('# ')
+                offsets[current_section] = {'header' : row, 'start' : row + 1, 'stop' : row + 1}
+            elif current_section is not None:
+                offsets[current_section]['stop'] = row + 1
+        return offsets
+
+    @property
+    def config_df(self):
+        return self._config_df_ref()
+
+    @property
+    def section_names(self):
+        return list(self.offsets.keys())
+
+    def get_columns(self, section_name):
+        assert section_name in self.offsets, f'Section {section_name} not found in {self.config_type} config'
+        return self.config_df.iloc[self.offsets[section_name]['header'],:].values
+
+    def get_frame(self, section_name):
+        '''
+        Return data rows of the section as df. Anatomy frames have the section header as column names.
+        Index is the row index of config_df. Frames are parsed once, copy before modifying.
+        '''
+        if section_name not in self._frames:
+            offsets = self.offsets[section_name]
+            section_df = self.config_df.iloc[offsets['start']:offsets['stop'],:]
+            if self.config_type == 'anatomy':
+                section_df = self.set_dtypes(section_df, columns=self.get_columns(section_name))
+            self._frames[section_name] = section_df
+        return self._frames[section_name]
+
+    @staticmethod
+    def _get_typed_column(column_s, column_name):
+        if column_name in CATEGORICAL_COLUMNS:
+            return column_s.astype('category')
+        not_null = column_s.notna()
+        if not not_null.any():
+            return column_s
+        numeric_s = pd.to_numeric(column_s, errors='coerce')
+        if numeric_s.notna().sum() < not_null.sum():
+            # Strings in column, keep as is
+            return column_s
+        if (numeric_s.dropna() % 1 == 0).all():
+            return numeric_s.astype('Int64')
+        return numeric_s.astype('Float64')
+
+    @classmethod
+    def set_dtypes(cls, section_df, columns=None):
+        '''
+        Return copy of anatomy section df with categorical, nullable numeric and object columns.
+        Columns are handled by position, because the empty column names (NaN) are duplicates.
+        '''
+        if columns is None:
+            columns = section_df.columns
+        typed_columns = {i : cls._get_typed_column(section_df.iloc[:,i], column_name)
+                            for i, column_name in enumerate(columns)}
+        typed_df = pd.DataFrame(typed_columns, index=section_df.index)
+        typed_df.columns = columns
+        return typed_df
+
+    @staticmethod
+    def get_config_values(section_df):
+        # CxSystem2 form of typed df: object array, missing values as NaN
+        if not isinstance(section_df, pd.DataFrame):
+            return np.asarray(section_df, dtype=object)
+        return section_df.astype(object).mask(section_df.isna().values, np.nan).to_numpy()
+
+    def splice(self, new_sections, append=False):
+        '''
+        Return new config df, where data rows of the sections in new_sections dict {section_name: df} are
+        replaced by, or if append, followed by the new rows. Other rows are kept as is. The new df is
+        assembled in one copy. New rows can have fewer columns than config_df, the rest are set to NaN.
+        Typed new rows are converted back to CxSystem2 form, ie the returned df is ready for writing.
+        '''
+        pieces = []
+        previous_stop = 0
+        config_values = self.config_df.to_numpy(dtype=object)
+        for section_name in sorted(new_sections, key=lambda name: self.offsets[name]['start']):
+            offsets = self.offsets[section_name]
+            new_values = self.get_config_values(new_sections[section_name])
+            assert new_values.shape[1] <= self.n_columns, f'Too many columns for section {section_name}'
+            padded_values = np.full((new_values.shape[0], self.n_columns), np.nan, dtype=object)
+            padded_values[:, :new_values.shape[1]] = new_values
+
+            keep_until = offsets['stop'] if append else offsets['start']
+            pieces.append(config_values[previous_stop:keep_until,:])
+            pieces.append(padded_values)
+            previous_stop = offsets['stop']
+        pieces.append(config_values[previous_stop:,:])
+
+        return pd.DataFrame(np.concatenate(pieces, axis=0), columns=self.config_df.columns)
+
+
 class Config:
 
     '''
     This class contains general objects, concerning all areas and connections. It is here for general data and methods.
     '''    
     
+    # Parsed configs, {id(config_df): ConfigSections}. Entries are dropped when their config df is collected.
+    _config_sections = {}
+
+    @classmethod
+    def get_config_sections(cls, config_df):
+        # Parse each config df only once. The identity check guards against an id reused by a new df.
+        key = id(config_df)
+        config_sections = cls._config_sections.get(key)
+        if config_sections is None or config_sections.config_df is not config_df:
+            config_sections = ConfigSections(config_df)
+            cls._config_sections[key] = config_sections
+            weakref.finalize(config_df, cls._config_sections.pop, key, None)
+        return config_sections
+
     @classmethod
     def get_data_from_anat_config_df(cls, anat_df, datatype='G'):
 
-        # Get and set column names for neuron groups
-        data_columns = anat_df.loc[anat_df.groupby([0]).get_group(datatype).index[0]-1,:].values
-        neuron_groups_df = anat_df.groupby([0]).get_group(datatype)
-        neuron_groups_df.columns = data_columns
+        # Get neuron groups (G) or connections (S) with their column names
+        config_sections = cls.get_config_sections(anat_df)
+        data_columns = config_sections.get_columns(datatype)
+        neuron_groups_df = config_sections.get_frame(datatype).copy()
 
         return neuron_groups_df, data_columns
 
@@ -339,28 +504,28 @@ class Groups(Config):
         anatomy_config_df_new = self.anatomy_config_df_new
         existing_neuron_groups, cell_group_columns = self.get_data_from_anat_config_df(anatomy_config_df_new, 'G') 
         PointNeurons_df, CompartmentalNeurons_df = self.get_neuron_types()
-        
-        assert '### NEURON GROUP PARAMETERS ###' in physiology_df[0].values, \
-            '''Sorry but you need to mark the cut point (start of neuron subgroup ephys properties) 
-            in the physiology configuration file with "### NEURON GROUP PARAMETERS ###", because 
+        physiology_sections = self.get_config_sections(physiology_df)
+
+        assert 'NEURON GROUP PARAMETERS' in physiology_sections.section_names, \
+            '''Sorry but you need to mark the cut point (start of neuron subgroup ephys properties)
+            in the physiology configuration file with "### NEURON GROUP PARAMETERS ###", because
             the guy who programmed me is dead-lazy'''
-        cutoff_index = physiology_df.loc[physiology_df[0]=='### NEURON GROUP PARAMETERS ###'].index.values[0]
+        neuron_group_parameters_df = physiology_sections.get_frame('NEURON GROUP PARAMETERS')
+        cutoff_index = physiology_sections.offsets['NEURON GROUP PARAMETERS']['header']
 
         # Sniff physiology_df for input group, assuming INPUTGROUPNAME,,,\,,, in the csv file
-        df_to_sniff = physiology_df.loc[cutoff_index:]
-        empty_rows_following_cutoff = df_to_sniff[df_to_sniff.isnull().all(axis=1)].index.values - cutoff_index
-        if empty_rows_following_cutoff[0] == 2:
-            input_group = df_to_sniff.iloc[1:2,0].values[0]
+        empty_rows_following_cutoff = np.flatnonzero(neuron_group_parameters_df.isnull().all(axis=1).values) + 1
+        collect_subtype_values_list = []
+        if len(empty_rows_following_cutoff) > 0 and empty_rows_following_cutoff[0] == 2:
+            input_group = neuron_group_parameters_df.iloc[0,0]
             assert isinstance(input_group, str), f'Not typical input group expression in physiology config at line {cutoff_index + 1}, aborting...'
             print(f"Warning: Adding assumed input group {input_group}")
-            physiology_df_stub = physiology_df.loc[:cutoff_index + 2]
+            # Keep input group and the empty row after it
+            collect_subtype_values_list.append(neuron_group_parameters_df.iloc[:2,:].to_numpy(dtype=object))
             # Flag input group to Config class object for later use
             Config.input_group = 1
-        else:
-            physiology_df_stub = physiology_df.loc[:cutoff_index]
 
         unique_subtypes = existing_neuron_groups['neuron_subtype'].unique()
-        collect_subtype_dataframes_list = []
 
         for neuron_subtype in unique_subtypes:
             # Get matching type
@@ -380,16 +545,17 @@ class Groups(Config):
             else:
                 raise NotImplementedError('neuron_type not recognized, requested types do not match neuron_group_ephys_templates? Aborting...')
 
-            # Create subtype df
-            data = [[neuron_subtype], keys.values.tolist(), values.values.tolist()]
-            subtype_ephys_df = pd.DataFrame(data).T
-            # Append empty row to the end of df
-            subtype_ephys_df = subtype_ephys_df.append(pd.Series(), ignore_index=True)
+            # Create subtype rows: name on the first row, then keys and values. Last row is empty.
+            subtype_values = np.full((len(keys) + 1, physiology_sections.n_columns), np.nan, dtype=object)
+            subtype_values[0,0] = neuron_subtype
+            subtype_values[:-1,1] = keys.values
+            subtype_values[:-1,2] = values.values
             # => append to list
-            collect_subtype_dataframes_list.append(subtype_ephys_df)
-        all_subtype_ephys_df = pd.concat(collect_subtype_dataframes_list,ignore_index=True)    
-        # Append to physiology_df_stub
-        physiology_df_with_subgroups = pd.concat([physiology_df_stub, all_subtype_ephys_df],ignore_index=True)
+            collect_subtype_values_list.append(subtype_values)
+
+        # Replace neuron group parameters, assembling physiology df once
+        all_subtype_values = np.concatenate(collect_subtype_values_list, axis=0)
+        physiology_df_with_subgroups = physiology_sections.splice({'NEURON GROUP PARAMETERS' : all_subtype_values})
 
         return physiology_df_with_subgroups
 
@@ -471,15 +637,16 @@ class Groups(Config):
 
 
         # Get and set column names for neuron groups
+        anatomy_sections = self.get_config_sections(anatomy_config_df)
         existing_neuron_groups, cell_group_columns = self.get_data_from_anat_config_df(anatomy_config_df, 'G')
 
         # Get starting index for cell groups and row indices for anat df
         if self.replace_existing_cell_groups:
             start_cell_group_index = 1 # Reserve 0 for input group
-            start_index = anatomy_config_df.groupby([0]).get_group('G').index[0]
+            start_index = anatomy_sections.offsets['G']['start']
         else:
             start_cell_group_index = int(existing_neuron_groups['idx'].values[-1]) + 1
-            start_index = anatomy_config_df.groupby([0]).get_group('G').index[-1] + 1
+            start_index = anatomy_sections.offsets['G']['stop']
 
         # Count number of new groups, ie number of new rows
         index_excitatory_s = excitatory_proportions_df.fillna(0).astype(bool).sum()
@@ -555,16 +722,11 @@ class Groups(Config):
 
         assert current_group_index == indices[-1] + 1, 'oh-ou'
 
-        # Add to anatomy df
-
-        # Change column names
-        NG_df.columns = anatomy_config_df.columns
+        # Typed columns for the new groups
+        NG_df = ConfigSections.set_dtypes(NG_df)
 
-        # Get end of cell groups index for slicing original anat df
-        end_index = anatomy_config_df.groupby([0]).get_group('G').index[-1] + 1
-        anatomy_config_df_beginning = anatomy_config_df.iloc[:start_index,:] 
-        anatomy_config_df_end = anatomy_config_df.iloc[end_index:,:] 
-        anatomy_config_df_new = pd.concat([anatomy_config_df_beginning, NG_df, anatomy_config_df_end], ignore_index=True)
+        # Add to anatomy df, replacing or following the existing cell groups
+        anatomy_config_df_new = anatomy_sections.splice({'G' : NG_df}, append=not self.replace_existing_cell_groups)
 
         return anatomy_config_df_new
 
@@ -820,10 +982,11 @@ class Connections(Config):
         existing_connection, connection_columns = self.get_data_from_anat_config_df(self.anatomy_config_df, 'S')
 
         # Get starting index for connections and row indices for anat df
+        anatomy_sections = self.get_config_sections(anatomy_config_df_new_groups)
         if self.replace_existing_cell_groups:
-            start_index = anatomy_config_df_new_groups.groupby([0]).get_group('S').index[0]
+            start_index = anatomy_sections.offsets['S']['start']
         else:
-            start_index = anatomy_config_df_new_groups.groupby([0]).get_group('S').index[-1] + 1
+            start_index = anatomy_sections.offsets['S']['stop']
 
         # N_rows = self._get_n_connection_rows(group_object, excitatory_connections_df, inhibitory_connections_df, excitatory_proportions_df, inhibitory_proportions_df, layerNames2layerIdx_dict)
         N_rows = N_MAX_NEW_CONNECTIONS
@@ -891,21 +1054,15 @@ class Connections(Config):
         # Cut extra rows
         assert current_connection_index < N_MAX_NEW_CONNECTIONS + start_index,\
             f'''Increase constant N_MAX_NEW_CONNECTIONS, now {N_MAX_NEW_CONNECTIONS} but you have {current_connection_index-start_index} connections'''
-        syn_df = syn_df.loc[:current_connection_index - 1,:]
+        syn_df = ConfigSections.set_dtypes(syn_df.loc[:current_connection_index - 1,:])
 
         # Sort to 1-source neuron group, 2-E,I
         # Because neuron groups are numbered from layer 1 downwards, E first, we get
         # sorted as source layer E -> target neuron group  E, I -> source layer I -> target neuron group E, I
         syn_df = syn_df.sort_values(by=['pre_syn_idx', 'receptor'])
 
-        # Change column names
-        syn_df.columns = anatomy_config_df_new_groups.columns
-        
-        # Get anat config df first new connection index
-        anatomy_config_df_beginning = anatomy_config_df_new_groups.iloc[:start_index,:] 
-        
-        # Concatenate, ignore sorted syn_df index
-        anatomy_config_df_new = pd.concat([anatomy_config_df_beginning, syn_df], ignore_index=True)
+        # Add to anatomy df, replacing or following the existing connections. Sorted syn_df index is ignored.
+        anatomy_config_df_new = anatomy_sections.splice({'S' : syn_df}, append=not self.replace_existing_cell_groups)
 
         return anatomy_config_df_new
 
@@ -1128,12 +1285,15 @@ class Connections(Config):
 
         # Replace csv layer names with idx. The FL_proportions and TL_proportions indicate
         # relative layer thickness in comparison to Table 2 layers.
-        connection_df_ni_names['FromLayer'] = connection_df_ni_names['FromLayer'].replace(csv2idx_dict)
-        connection_df_ni_names['ToLayer'] = connection_df_ni_names['ToLayer'].replace(csv2idx_dict)
+        # Mapping, not replacing, keeps the columns numeric. Unmapped csv layers become NA.
+        csv2idx_s = pd.Series(csv2idx_dict, dtype='Int64')
+        csv2proportion_s = pd.Series(csv2proportion_dict, dtype='float64')
+        connection_df_ni_names['FromLayer'] = connection_df_ni_names['FromLayer'].map(csv2idx_s)
+        connection_df_ni_names['ToLayer'] = connection_df_ni_names['ToLayer'].map(csv2idx_s)
         connection_df_ni_names['FL_proportions'] = \
-            connection_df_ni_names['FL_proportions'].replace(csv2proportion_dict)
+            connection_df_ni_names['FL_proportions'].map(csv2proportion_s)
         connection_df_ni_names['TL_proportions'] = \
-            connection_df_ni_names['TL_proportions'].replace(csv2proportion_dict)
+            connection_df_ni_names['TL_proportions'].map(csv2proportion_s)
 
         # Now we just skip the rows not matching either pre- or postsynaptic layers
         layer_idxs = layer_name_mapping_df_groups.layer_idx.unique()
@@ -1204,15 +1364,12 @@ class Connections(Config):
         cw2p_dict = dict(zip(['D', 'M', 'S'],[0.75, 0.3, 0.05]))
         apc = 0.1
         sw = tw = 1
-        connection_df_ni_names['Strength'] = connection_df_ni_names['Strength'].replace(cw2p_dict)
+        connection_df_ni_names['Strength'] = connection_df_ni_names['Strength'].map(cw2p_dict)
         connection_df_ni_names['p_partial'] = \
             sw * (connection_df_ni_names['Strength'] / 0.5) * tw * apc * \
             connection_df_ni_names['FL_proportions'] * connection_df_ni_names['TL_proportions']
             
         # Scale each unique set of partial connections to total FL_portion + TL_portion = 2
-        # Change appropriate columns' data types to float. Mixed integers seemed to make these "objects"
-        connection_df_ni_names = connection_df_ni_names.astype({'FL_proportions': 'float', 'TL_proportions': 'float', 'p_partial': 'float'})        
-        
         # Group according to unique connections and sum all float columns
         connection_df_ni_names_unique = connection_df_ni_names.groupby(['FromLayer','ToLayer']).sum()
         connection_df_ni_names_unique = connection_df_ni_names_unique.reset_index()
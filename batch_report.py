@@ -0,0 +1,219 @@
+'''
+Render figures for many result files without a display, in a process pool.
+
+Each results file gets its own directory under the output path, and index.html at the output path
+shows all figures. A figure is rendered again only if its source file is newer than the saved figure.
+
+Usage, eg
+    python batch_report.py --path /data/ASF_run --output /data/ASF_run/report
+    python batch_report.py file1_results.gz file2_results.gz --figures vm spatial --n_workers 8
+'''
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import os
+import sys
+import glob
+import html
+import argparse
+import utilities as ut
+from internal_model import InternalModel
+
+# Figure types, in index page order. Source file type is 'results' or 'connections'.
+FIGURE_SOURCES = {
+    'connections' : 'connections',
+    'vm' : 'results',
+    'g' : 'results',
+    'i' : 'results',
+    'spatial' : 'results',
+    'spectra' : 'results',
+    'internal' : 'results',
+    }
+
+FIGURE_FUNCTIONS = {
+    'connections' : ut.showLatestConnections,
+    'vm' : ut.showLatestVm,
+    'g' : ut.showLatestG,
+    'i' : ut.showLatestI,
+    'spatial' : ut.showLatestSpatial,
+    'spectra' : ut.showLatestSpectra,
+    }
+
+
+def getResultsFilenames(path='./', query='results'):
+    # All data files in path with query in the filename, as _newest finds them
+    filenames = [   os.path.join(path, f) for f in sorted(os.listdir(path))
+                    if query in f and os.path.splitext(f)[1] in ('.gz', '.mat')]
+    return [f for f in filenames if os.path.isfile(f)]
+
+def _getRunDir(output_path, results_filename):
+    return os.path.join(output_path, os.path.splitext(os.path.basename(results_filename))[0])
+
+def _getFigureName(figure_type, ng_name=None):
+    if figure_type == 'internal':
+        return f'internal_{ng_name}'
+    return figure_type
+
+def _getSavedFigures(run_dir, figure_name, myformat):
+    # One figure is figure_name.png, several are figure_name_0.png, figure_name_1.png, ...
+    single = os.path.join(run_dir, f'{figure_name}.{myformat}')
+    if os.path.isfile(single):
+        return [single]
+    return sorted(glob.glob(os.path.join(glob.escape(run_dir), f'{figure_name}_[0-9]*.{myformat}')))
+
+def _isUpToDate(saved_figures, source_filename):
+    if not saved_figures:
+        return False
+    source_mtime = os.path.getmtime(source_filename)
+    return all(os.path.getmtime(f) >= source_mtime for f in saved_figures)
+
+def _saveOpenFigures(run_dir, figure_name, myformat, dpi):
+    # showLatest* functions may open several figures. Save all, then close them.
+    figure_numbers = plt.get_fignums()
+    saved_figures = []
+    for idx, figure_number in enumerate(figure_numbers):
+        if len(figure_numbers) == 1:
+            figure_filename = os.path.join(run_dir, f'{figure_name}.{myformat}')
+        else:
+            figure_filename = os.path.join(run_dir, f'{figure_name}_{idx}.{myformat}')
+        plt.figure(figure_number).savefig(figure_filename, format=myformat, dpi=dpi)
+        saved_figures.append(figure_filename)
+    plt.close('all')
+    return saved_figures
+
+def _renderFigure(figure_type, results_filename, source_filename, ng_name):
+    path, filename = os.path.split(source_filename)
+    if figure_type == 'internal':
+        InternalModel(ng_name=ng_name, filename=os.path.basename(results_filename),
+                        path=os.path.dirname(results_filename))
+    else:
+        FIGURE_FUNCTIONS[figure_type](path=path, filename=filename)
+
+def renderReport(results_filename, output_path, figure_types, myformat='png', dpi=100, ng_names=(), force=False):
+    '''
+    Render figure_types for one results file to its run directory under output_path. Figures newer than
+    their source file are not rendered again, unless force. Returns dict with the saved figure filenames
+    for each figure name, and dict of error messages for figures that failed.
+    '''
+    run_dir = _getRunDir(output_path, results_filename)
+    os.makedirs(run_dir, exist_ok=True)
+
+    figures = {}
+    errors = {}
+    for figure_type in figure_types:
+        if FIGURE_SOURCES[figure_type] == 'connections':
+            source_filename = ut.getConnectionsFilename(results_filename)
+        else:
+            source_filename = results_filename
+        if source_filename is None:
+            errors[figure_type] = 'connections file not found'
+            continue
+
+        for ng_name in (ng_names if figure_type == 'internal' else [None]):
+            figure_name = _getFigureName(figure_type, ng_name)
+            saved_figures = _getSavedFigures(run_dir, figure_name, myformat)
+            if not force and _isUpToDate(saved_figures, source_filename):
+                figures[figure_name] = saved_figures
+                continue
+
+            for f in saved_figures:
+                os.remove(f)
+            plt.close('all')
+            try:
+                _renderFigure(figure_type, results_filename, source_filename, ng_name)
+                figures[figure_name] = _saveOpenFigures(run_dir, figure_name, myformat, dpi)
+            except Exception as e:
+                plt.close('all')
+                errors[figure_name] = f'{type(e).__name__}: {e}'
+
+    return figures, errors
+
+def _renderReportWorker(results_filename, output_path, figure_types, myformat, dpi, ng_names, force):
+    # Module level function for the process pool. Printing from the showLatest functions is silenced.
+    with open(os.devnull, 'w') as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            return renderReport(results_filename, output_path, figure_types, myformat=myformat,
+                                dpi=dpi, ng_names=ng_names, force=force)
+        finally:
+            sys.stdout = stdout
+
+def writeIndex(output_path, reports):
+    '''
+    Write index.html to output_path, with one section for each results file. reports is a list of
+    (results_filename, figures, errors) as from renderReport.
+    '''
+    lines = ['<!DOCTYPE html>', '<html>', '<head><meta charset="utf-8"><title>Batch report</title></head>', '<body>']
+    for results_filename, figures, errors in reports:
+        lines.append(f'<h2>{html.escape(os.path.basename(results_filename))}</h2>')
+        for figure_name, saved_figures in figures.items():
+            for figure_filename in saved_figures:
+                relative_filename = os.path.relpath(figure_filename, output_path).replace(os.sep, '/')
+                lines.append(   f'<a href="{html.escape(relative_filename)}"><img src="{html.escape(relative_filename)}" '
+                                f'title="{html.escape(figure_name)}" height="300"></a>')
+        for figure_name, message in errors.items():
+            lines.append(f'<p>{html.escape(figure_name)} failed: {html.escape(message)}</p>')
+    lines += ['</body>', '</html>']
+
+    index_filename = os.path.join(output_path, 'index.html')
+    with open(index_filename, 'w', encoding='utf-8') as fi:
+        fi.write('\n'.join(lines))
+    return index_filename
+
+def batchReport(filenames=None, path='./', query='results', output_path=None, figure_types=None, myformat='png',
+                dpi=100, ng_names=None, n_workers=None, force=False):
+    '''
+    Render figures for results files, filenames or by default all files in path with query in their name,
+    to output_path (default path/report) and write the index page. Files are processed in a process pool
+    of n_workers. Returns index filename.
+    '''
+    if not filenames:
+        filenames = getResultsFilenames(path, query)
+    assert filenames, 'No results files found, aborting...'
+    if output_path is None:
+        output_path = os.path.join(os.path.dirname(filenames[0]), 'report')
+    if figure_types is None:
+        figure_types = list(FIGURE_SOURCES.keys())
+    for figure_type in figure_types:
+        assert figure_type in FIGURE_SOURCES, f'Unknown figure type {figure_type}, valid are {list(FIGURE_SOURCES.keys())}'
+    if ng_names is None:
+        ng_names = [InternalModel.ng_name]
+    os.makedirs(output_path, exist_ok=True)
+
+    reports = [None] * len(filenames)
+    worker_args = (output_path, figure_types, myformat, dpi, tuple(ng_names), force)
+    for file_index, (figures, errors) in ut._mapFilesInPool(_renderReportWorker, filenames, worker_args=worker_args,
+                                                            n_workers=n_workers):
+        reports[file_index] = (filenames[file_index], figures, errors)
+        for figure_name, message in errors.items():
+            print(f'{os.path.basename(filenames[file_index])}: {figure_name} failed: {message}')
+
+    return writeIndex(output_path, reports)
+
+def _parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description='Render figures for many result files to a browsable report')
+    parser.add_argument('filenames', nargs='*', help='Results files. Default all files in --path matching --query')
+    parser.add_argument('--path', default='./', help='Results directory')
+    parser.add_argument('--query', default='results', help='Substring of results filenames in --path')
+    parser.add_argument('--output', default=None, help='Report directory, default <results directory>/report')
+    parser.add_argument('--figures', nargs='+', default=None, choices=list(FIGURE_SOURCES.keys()),
+                        help='Figure types, default all')
+    parser.add_argument('--ng_names', nargs='+', default=None, help='Neuron groups for internal images')
+    parser.add_argument('--format', default='png', help='Figure file format')
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--n_workers', type=int, default=None, help='Number of processes, default number of cpus')
+    parser.add_argument('--force', action='store_true', help='Render also figures which are up to date')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = _parseArguments(argv)
+    index_filename = batchReport(   filenames=args.filenames, path=args.path, query=args.query, output_path=args.output,
+                                    figure_types=args.figures, myformat=args.format, dpi=args.dpi,
+                                    ng_names=args.ng_names, n_workers=args.n_workers, force=args.force)
+    print(index_filename)
+
+
+if __name__=='__main__':
+    main()
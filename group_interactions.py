@@ -0,0 +1,320 @@
+'''
+Interactions between neuron groups: coherence of group mean Vm or population rates, 
+cross-correlograms of binned population spike counts, and transfer entropy between binary
+spike trains, for all group pairs at once.
+
+Each signal is Fourier transformed once. Cross-spectra of all pairs are then products of the
+transforms, [groups, groups, freqs] in one array operation. Transfer entropy counts joint history
+patterns of bit-packed trains with bincount. Results are cached per results file, thus showFigure 
+in neuron_group_figure renders without recomputation.
+'''
+
+import numpy as np
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from scipy import fft
+from scipy.signal import get_window
+from utilities import getData, getFiringRates, _getCacheFilename, _saveCache, _loadCache
+
+
+def _getSegments(signals, len_segment, noverlap):
+    # Detrended welch segments [n_signals, n_segments, len_segment], a strided view before detrending
+    step = len_segment - noverlap
+    n_samples = signals.shape[1]
+    segment_starts = np.arange(0, n_samples - len_segment + 1, step)
+    windows = np.lib.stride_tricks.sliding_window_view(signals, len_segment, axis=1)[:, segment_starts, :]
+    return windows - windows.mean(axis=2, keepdims=True)
+
+def getCoherence(signals, fs, n_segments=8, overlap=0.5):
+    '''
+    Magnitude squared coherence of all pairs of signals [n_signals, n_samples] sampled at fs. Welch segments
+    as in getPSD in utilities, hann window. Returns freqs and coherence [n_signals, n_signals, n_freqs].
+    '''
+    signals = np.asarray(signals, dtype=float)
+    n_samples = signals.shape[1]
+    len_segment = int(2 * n_samples / (n_segments + 1))
+    noverlap = int(len_segment * overlap)
+
+    segments = _getSegments(signals, len_segment, noverlap)
+    segments = segments * get_window('hann', len_segment)
+    # One FFT per signal segment, then all cross-spectra averaged over segments
+    spectra = fft.rfft(segments, axis=2)
+    cross_spectra = np.einsum('isf,jsf->ijf', spectra, np.conj(spectra)) / spectra.shape[1]
+    auto_spectra = np.real(np.diagonal(cross_spectra, axis1=0, axis2=1)).T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coherence = np.abs(cross_spectra) ** 2 / (auto_spectra[:, np.newaxis, :] * auto_spectra[np.newaxis, :, :])
+    freqs = fft.rfftfreq(len_segment, d=1 / fs)
+    return freqs, coherence
+
+def getCrossCorrelograms(counts, bin_length, max_lag=0.05):
+    '''
+    Cross-correlograms of all pairs of binned spike counts [n_signals, n_bins], for lags -max_lag to max_lag
+    seconds. ccg[i, j, lag] is the correlation coefficient of counts i at t and counts j at t + lag.
+    Returns lags in seconds and ccg [n_signals, n_signals, n_lags].
+    '''
+    counts = np.asarray(counts, dtype=float)
+    n_bins = counts.shape[1]
+    max_lag_bins = min(int(round(max_lag / bin_length)), n_bins - 1)
+
+    centered = counts - counts.mean(axis=1, keepdims=True)
+    # Zero padding to at least 2 * n_bins - 1 avoids circular wrap-around
+    n_fft = fft.next_fast_len(2 * n_bins - 1, real=True)
+    spectra = fft.rfft(centered, n=n_fft, axis=1)
+    correlations = fft.irfft(np.conj(spectra)[:, np.newaxis, :] * spectra[np.newaxis, :, :], n=n_fft, axis=2)
+    lag_indices = np.arange(-max_lag_bins, max_lag_bins + 1) % n_fft
+    correlations = correlations[:, :, lag_indices]
+
+    norms = np.sqrt(np.sum(centered ** 2, axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ccg = correlations / (norms[:, np.newaxis, np.newaxis] * norms[np.newaxis, :, np.newaxis])
+    lags = np.arange(-max_lag_bins, max_lag_bins + 1) * bin_length
+    return lags, ccg
+
+def _getGroupMeanVm(data, neuron_groups):
+    # Group mean vm [n_groups, n_samples] and sampling frequency
+    vm_means = [np.asarray(data['vm_all'][g]['vm'], dtype=float).mean(axis=1) for g in neuron_groups]
+    t = np.asarray(data['vm_all'][neuron_groups[0]]['t'], dtype=float)
+    fs = (len(t) - 1) / (t[-1] - t[0])
+    return np.stack(vm_means), fs
+
+def _getDefaultNeuronGroups(data=None, filename=None, use_cache=True):
+    '''
+    Neuron groups with spikes monitored, from data or from results filename. The group names of a file are 
+    cached, so that the cache keys of the results can be made without loading the file. Returns the groups
+    and data, which is loaded only if needed.
+    '''
+    use_cache = use_cache and filename is not None
+    if use_cache:
+        path, basename = os.path.split(filename)
+        cache_filename = _getCacheFilename(path, f'{os.path.splitext(basename)[0]}_spike_groups')
+        if data is None:
+            neuron_groups = _loadCache(cache_filename, source_filenames=[filename])
+            if neuron_groups is not None:
+                return neuron_groups, data
+    if data is None:
+        data = getData(filename)
+    neuron_groups = [n for n in data['spikes_all'].keys() if 'NG' in n]
+    if use_cache:
+        _saveCache(cache_filename, neuron_groups)
+    return neuron_groups, data
+
+def getGroupInteractions( data=None, filename=None, neuron_groups=None, signal='vm', n_segments=8, freq_max=None,
+                            bin_length=0.001, max_lag=0.05, use_cache=True):
+    '''
+    Coherence and cross-correlograms of all neuron group pairs of one results file. Coherence is computed from
+    group mean vm (signal='vm', groups with vm monitored) or population rates in bin_length bins (signal='rate').
+    Cross-correlograms are from population spike counts in bin_length bins.
+
+    Returns dict with
+        'neuron_groups' : group order of the pair axes
+        'coherence_groups' : groups in the coherence axes
+        'freqs', 'coherence' : frequencies below freq_max and coherence [groups, groups, freqs]
+        'lags', 'ccg' : lags in seconds and cross-correlograms [groups, groups, lags]
+    If filename is given, the result is cached for this file and parameters.
+    '''
+    if neuron_groups is None:
+        neuron_groups, data = _getDefaultNeuronGroups(data=data, filename=filename, use_cache=use_cache)
+    if filename is not None and use_cache:
+        parameters = repr((list(neuron_groups), signal, n_segments, freq_max, bin_length, max_lag))
+        parameter_hash = hashlib.sha1(parameters.encode()).hexdigest()[:12]
+        path, basename = os.path.split(filename)
+        cache_filename = _getCacheFilename(path, f'{os.path.splitext(basename)[0]}_interactions_{parameter_hash}')
+        interactions = _loadCache(cache_filename, source_filenames=[filename])
+        if interactions is not None:
+            return interactions
+    if data is None:
+        data = getData(filename)
+
+    runtime = float(np.asarray(data['runtime']))
+    n_time_bins = int(round(runtime / bin_length))
+    rates_dict = getFiringRates(data=data, neuron_groups=neuron_groups, n_time_bins=n_time_bins, sum_length=None)
+    counts = np.stack([rates_dict[g]['counts'][:, 0] for g in neuron_groups])
+    lags, ccg = getCrossCorrelograms(counts, bin_length, max_lag=max_lag)
+
+    if signal == 'vm':
+        coherence_groups = [g for g in neuron_groups if g in data['vm_all']]
+        if coherence_groups:
+            signals, fs = _getGroupMeanVm(data, coherence_groups)
+    elif signal == 'rate':
+        coherence_groups = neuron_groups
+        signals, fs = counts, 1 / bin_length
+    else:
+        raise NotImplementedError(f'Unknown signal {signal}, valid are vm and rate')
+    if coherence_groups:
+        freqs, coherence = getCoherence(signals, fs, n_segments=n_segments)
+    else:
+        freqs, coherence = np.zeros(0), np.zeros((0, 0, 0))
+    if freq_max is not None:
+        coherence = coherence[:, :, freqs < freq_max]
+        freqs = freqs[freqs < freq_max]
+
+    interactions = {
+        'neuron_groups' : neuron_groups,
+        'coherence_groups' : coherence_groups,
+        'freqs' : freqs,
+        'coherence' : coherence,
+        'lags' : lags,
+        'ccg' : ccg,
+        }
+
+    if filename is not None and use_cache:
+        _saveCache(cache_filename, interactions)
+
+    return interactions
+
+def getBinaryTrains(data, neuron_groups, bin_length=0.002, level='group'):
+    '''
+    Spikes binned to binary trains (1 if any spike in bin), packed with np.packbits along time. With 
+    level='group' there is one population train per group, with level='neuron' one train per neuron.
+    Returns packed trains [n_trains, n_bytes], number of bins and label of each train (group name or
+    (group name, neuron index)).
+    '''
+    runtime = float(np.asarray(data['runtime']))
+    n_bins = int(round(runtime / bin_length))
+    packed_list = []
+    labels = []
+    for neuron_group in neuron_groups:
+        t = np.asarray(data['spikes_all'][neuron_group]['t'], dtype=float)
+        i = np.asarray(data['spikes_all'][neuron_group]['i'], dtype=np.int64)
+        time_bins = np.minimum((t / bin_length).astype(np.int64), n_bins - 1)
+        if level == 'group':
+            trains = np.zeros((1, n_bins), dtype=bool)
+            trains[0, time_bins] = True
+            labels.append(neuron_group)
+        elif level == 'neuron':
+            n_neurons = len(data['spikes_all'][neuron_group]['count'])
+            trains = np.zeros((n_neurons, n_bins), dtype=bool)
+            trains[i, time_bins] = True
+            labels += [(neuron_group, neuron_index) for neuron_index in range(n_neurons)]
+        else:
+            raise NotImplementedError(f'Unknown level {level}, valid are group and neuron')
+        packed_list.append(np.packbits(trains, axis=1))
+    return np.concatenate(packed_list, axis=0), n_bins, labels
+
+def _getHistoryCodes(trains, history_length, n_skip):
+    '''
+    Past history_length bins of binary trains [n_trains, n_bins] as integer codes, most recent bin in the 
+    lowest bit. Code at position p describes bins before bin p + n_skip, so that all codes are aligned with 
+    the predicted bins trains[:, n_skip:]. Codes are in the smallest unsigned dtype holding 2**history_length states.
+    '''
+    n_bins = trains.shape[1]
+    dtype = np.min_scalar_type(2 ** history_length - 1)
+    codes = np.zeros((trains.shape[0], n_bins - n_skip), dtype=dtype)
+    for lag in range(1, history_length + 1):
+        codes |= np.left_shift(trains[:, n_skip - lag:n_bins - lag], lag - 1, dtype=dtype)
+    return codes
+
+def _transferEntropyFromCounts(counts):
+    '''
+    Transfer entropy in bits from joint counts [..., 2, n_target_states, n_source_states] of
+    (next target bin, target history, source history).
+    '''
+    counts = np.asarray(counts, dtype=float)
+    n_total = counts.sum(axis=(-3, -2, -1), keepdims=True)
+    counts_target_source = counts.sum(axis=-3, keepdims=True)
+    counts_next_target = counts.sum(axis=-1, keepdims=True)
+    counts_target = counts.sum(axis=(-3, -1), keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log_ratio = np.log2(counts * counts_target / (counts_target_source * counts_next_target))
+        terms = np.where(counts > 0, counts / n_total * log_ratio, 0)
+    return terms.sum(axis=(-3, -2, -1))
+
+# Trains and history codes for process pool workers, set once per worker by _initTransferEntropyWorker
+_te_worker_state = {}
+
+def _initTransferEntropyWorker(packed_trains, n_bins, history_length, source_history_length, max_block_size):
+    # Trains stay uint8, one byte per bin, and history codes use the smallest dtype. Only one target
+    # and one block of sources are widened to int64 at a time in _transferEntropyToTarget.
+    trains = np.unpackbits(packed_trains, axis=1, count=n_bins)
+    n_skip = max(history_length, source_history_length)
+    _te_worker_state['next_bins'] = trains[:, n_skip:]
+    _te_worker_state['target_codes'] = _getHistoryCodes(trains, history_length, n_skip)
+    if source_history_length == history_length:
+        _te_worker_state['source_codes'] = _te_worker_state['target_codes']
+    else:
+        _te_worker_state['source_codes'] = _getHistoryCodes(trains, source_history_length, n_skip)
+    _te_worker_state['history_length'] = history_length
+    _te_worker_state['source_history_length'] = source_history_length
+    _te_worker_state['max_block_size'] = max_block_size
+
+def _transferEntropyToTarget(target_index):
+    '''
+    Transfer entropy from all trains to train target_index. Joint (next, target history, source history)
+    codes of all sources are counted with one bincount per block of sources.
+    '''
+    state = _te_worker_state
+    source_codes = state['source_codes']
+    n_sources, n_samples = source_codes.shape
+    n_source_states = 2 ** state['source_history_length']
+    n_target_states = 2 ** state['history_length']
+    n_states = 2 * n_target_states * n_source_states
+
+    target_part = ( state['next_bins'][target_index].astype(np.int64) * n_target_states + 
+                    state['target_codes'][target_index]) * n_source_states
+    n_sources_per_block = max(1, int(state['max_block_size'] // n_samples))
+    te = np.zeros(n_sources)
+    for block_start in range(0, n_sources, n_sources_per_block):
+        block_codes = source_codes[block_start:block_start + n_sources_per_block]
+        n_block = block_codes.shape[0]
+        joint_codes = (target_part[np.newaxis, :] + block_codes) + (np.arange(n_block) * n_states)[:, np.newaxis]
+        counts = np.bincount(joint_codes.ravel(), minlength=n_block * n_states)
+        te[block_start:block_start + n_block] = _transferEntropyFromCounts(
+                                                    counts.reshape(n_block, 2, n_target_states, n_source_states))
+    te[target_index] = np.nan
+    return te
+
+def getTransferEntropy( data=None, filename=None, neuron_groups=None, bin_length=0.002, history_length=1, 
+                        source_history_length=None, level='group', n_workers=None, max_block_size=2**24, use_cache=True):
+    '''
+    Transfer entropy, in bits per bin, between all pairs of binary spike trains. Trains are population trains 
+    of neuron groups (level='group') or single neuron trains (level='neuron'), bins of bin_length seconds. 
+    Target history is history_length bins and source history source_history_length bins (default same). 
+    Targets are divided to a process pool of n_workers, n_workers=1 runs here.
+
+    Returns dict with
+        'labels' : train labels, see getBinaryTrains
+        'te' : transfer entropy [sources, targets], te[i, j] from train i to train j, NaN on the diagonal
+    If filename is given, the result is cached for this file and parameters.
+    '''
+    if source_history_length is None:
+        source_history_length = history_length
+    if neuron_groups is None:
+        neuron_groups, data = _getDefaultNeuronGroups(data=data, filename=filename, use_cache=use_cache)
+    if filename is not None and use_cache:
+        parameters = repr((list(neuron_groups), bin_length, history_length, source_history_length, level))
+        parameter_hash = hashlib.sha1(parameters.encode()).hexdigest()[:12]
+        path, basename = os.path.split(filename)
+        cache_filename = _getCacheFilename(path, f'{os.path.splitext(basename)[0]}_te_{parameter_hash}')
+        te_dict = _loadCache(cache_filename, source_filenames=[filename])
+        if te_dict is not None:
+            return te_dict
+    if data is None:
+        data = getData(filename)
+
+    packed_trains, n_bins, labels = getBinaryTrains(data, neuron_groups, bin_length=bin_length, level=level)
+    n_trains = len(labels)
+    initargs = (packed_trains, n_bins, history_length, source_history_length, max_block_size)
+
+    te = np.zeros((n_trains, n_trains))
+    if n_workers == 1:
+        _initTransferEntropyWorker(*initargs)
+        for target_index in range(n_trains):
+            te[:, target_index] = _transferEntropyToTarget(target_index)
+        _te_worker_state.clear()
+    else:
+        # Packed trains are sent once to each worker, not with every target
+        with ProcessPoolExecutor(   max_workers=n_workers, initializer=_initTransferEntropyWorker, 
+                                    initargs=initargs) as executor:
+            chunksize = max(1, n_trains // (4 * (n_workers or os.cpu_count())))
+            for target_index, target_te in enumerate(executor.map(_transferEntropyToTarget, range(n_trains), 
+                                                                    chunksize=chunksize)):
+                te[:, target_index] = target_te
+
+    te_dict = {'labels' : labels, 'te' : te}
+
+    if filename is not None and use_cache:
+        _saveCache(cache_filename, te_dict)
+
+    return te_dict
@@ -3,15 +3,233 @@ Build images of receptive fields and internal representations of simulated data.
 '''
 
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, save_npz, load_npz
 import matplotlib.pyplot as plt
 import os
 import sys
-from utilities import getData, figsave
+import json
+import shutil
+import hashlib
+import tempfile
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from utilities import getData, figsave, getConnectionsFilename, _mapFilesInPool, CACHE_FOLDER_NAME
 import pdb
     
+class ConnectionGraph:
+    '''
+    Directed graph of neuron groups parsed once from connection names 'PRE__to__POST_COMPARTMENT'.
+    Nodes are group names (eg 'NG1_SS_L2') with integer ids, edges are arrays of source and target ids
+    with the compartment and connection name of each edge.
+    '''
+
+    def __init__(self, connection_data, group_names):
+
+        self.group_names = list(group_names)
+        self.group_ids = {group : idx for idx, group in enumerate(self.group_names)}
+        # Connection names use the group name without the NGx_ prefix
+        prefixes = {group[group.find('_') + 1:] : idx for idx, group in enumerate(self.group_names)}
+        # Longest prefixes first, so that eg SS_L2 does not match SS_L2_autoconn targets
+        prefixes_by_length = sorted(prefixes.keys(), key=len, reverse=True)
+
+        edge_sources = []
+        edge_targets = []
+        self.edge_compartments = []
+        self.edge_names = []
+        for connection in connection_data.keys():
+            if '__to__' not in connection:
+                continue
+            source_prefix = connection[:connection.find('__to__')]
+            target_suffix = connection[connection.find('__to__') + 6:]
+            if source_prefix not in prefixes:
+                continue
+            target_prefix = next((p for p in prefixes_by_length if target_suffix == p or target_suffix.startswith(p + '_')), None)
+            if target_prefix is None:
+                continue
+            edge_sources.append(prefixes[source_prefix])
+            edge_targets.append(prefixes[target_prefix])
+            self.edge_compartments.append(target_suffix[len(target_prefix) + 1:])
+            self.edge_names.append(connection)
+
+        self.edge_sources = np.array(edge_sources, dtype=np.int64)
+        self.edge_targets = np.array(edge_targets, dtype=np.int64)
+        self.n_nodes = len(self.group_names)
+        self.edge_ids = {name : idx for idx, name in enumerate(self.edge_names)}
+
+    def get_source(self, connection):
+        # Source group name of connection
+        return self.group_names[self.edge_sources[self.edge_ids[connection]]]
+
+    def get_edges(self, exclude_autoconn=True, exclude_self=True):
+        # Boolean mask of edges used for propagation
+        valid = np.ones(len(self.edge_names), dtype=bool)
+        if exclude_autoconn:
+            valid &= np.array(['autoconn' not in name for name in self.edge_names], dtype=bool)
+        if exclude_self:
+            valid &= self.edge_sources != self.edge_targets
+        return valid
+
+    def get_orders(self, input_group, max_order=2, exclude_autoconn=True):
+        '''
+        Breadth first search from input_group. Returns list of group name lists, order_groups[k] being the
+        groups first reached after k connections, and list of dicts order_connections[k], with the incoming
+        connection names of each order k group from order k - 1 groups.
+        '''
+        valid = self.get_edges(exclude_autoconn=exclude_autoconn)
+        edge_sources = self.edge_sources[valid]
+        edge_targets = self.edge_targets[valid]
+        edge_names = [name for name, is_valid in zip(self.edge_names, valid) if is_valid]
+
+        visited = np.zeros(self.n_nodes, dtype=bool)
+        frontier = np.zeros(self.n_nodes, dtype=bool)
+        frontier[self.group_ids[input_group]] = True
+        visited |= frontier
+        order_groups = [[input_group]]
+        order_connections = [{}]
+        for order in range(1, max_order + 1):
+            from_frontier = frontier[edge_sources]
+            next_frontier = np.zeros(self.n_nodes, dtype=bool)
+            next_frontier[edge_targets[from_frontier]] = True
+            next_frontier &= ~visited
+            if not next_frontier.any():
+                break
+            incoming = from_frontier & next_frontier[edge_targets]
+            connections_dict = {self.group_names[idx] : [] for idx in np.flatnonzero(next_frontier)}
+            for edge_idx in np.flatnonzero(incoming):
+                connections_dict[self.group_names[edge_targets[edge_idx]]].append(edge_names[edge_idx])
+            order_groups.append(list(connections_dict.keys()))
+            order_connections.append(connections_dict)
+            visited |= next_frontier
+            frontier = next_frontier
+
+        return order_groups, order_connections
+
+# Connection graphs by connections filename, see get_connection_graph
+_connection_graph_cache = {}
+
+def get_connection_graph(connection_filename, connection_data=None, group_names=None):
+    '''
+    ConnectionGraph for connections file, parsed once and kept in memory until the file changes.
+    Group names default to the groups in connection positions.
+    '''
+    key = (os.path.abspath(connection_filename), os.path.getmtime(connection_filename), 
+            tuple(group_names) if group_names is not None else None)
+    if key not in _connection_graph_cache:
+        if connection_data is None:
+            connection_data = getData(connection_filename)
+        if group_names is None:
+            group_names = connection_data['positions_all']['w_coord'].keys()
+        _connection_graph_cache[key] = ConnectionGraph(connection_data, group_names)
+    return _connection_graph_cache[key]
+
+# md5 of file contents by (filename, mtime, size), see _get_file_md5
+_file_md5_cache = {}
+
+def _get_file_md5(filename):
+    '''
+    md5 of file contents. The result is kept in memory and in cache/<filename>.md5.json next to the file,
+    keyed by mtime and size, so that parallel workers and later runs do not hash the file again.
+    '''
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime, stat.st_size)
+    if key in _file_md5_cache:
+        return _file_md5_cache[key]
+
+    md5_filename = os.path.join(os.path.dirname(filename), CACHE_FOLDER_NAME, os.path.basename(filename) + '.md5.json')
+    try:
+        with open(md5_filename) as fi:
+            saved = json.load(fi)
+        if saved['mtime'] == stat.st_mtime and saved['size'] == stat.st_size:
+            _file_md5_cache[key] = saved['md5']
+            return saved['md5']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fi:
+        for block in iter(lambda: fi.read(2**20), b''):
+            md5.update(block)
+    _file_md5_cache[key] = md5.hexdigest()
+
+    # Write to temporary file and rename, readers never see a partial file
+    os.makedirs(os.path.dirname(md5_filename), exist_ok=True)
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(md5_filename), suffix='.tmp')
+    with os.fdopen(fd, 'w') as fo:
+        json.dump({'mtime' : stat.st_mtime, 'size' : stat.st_size, 'md5' : _file_md5_cache[key]}, fo)
+    os.replace(tmp_filename, md5_filename)
+    return _file_md5_cache[key]
+
+class ReceptiveFieldCache(Mapping):
+    '''
+    Receptive fields saved as sparse .npz files, one per group, in the cache folder next to the connections
+    file. The folder name holds the md5 of the connections file contents and a hash of the group analysis
+    parameters, and manifest.json lists the groups. Matrices are loaded on first access.
+    '''
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, self.manifest_name)) as fi:
+            self.manifest = json.load(fi)
+        self._loaded = {}
+
+    @staticmethod
+    def get_cache_dir(connection_filename, all_group_names, input_group_prefix):
+        parameters = repr((sorted(all_group_names), input_group_prefix))
+        parameter_hash = hashlib.sha1(parameters.encode()).hexdigest()[:12]
+        return os.path.join(os.path.dirname(connection_filename), CACHE_FOLDER_NAME, 
+                            f'rf_{_get_file_md5(connection_filename)}_{parameter_hash}')
+
+    @classmethod
+    def save(cls, cache_dir, receptive_fields, connection_filename):
+        # Write to a temporary folder, which is then renamed to cache_dir. Parallel workers saving the same
+        # receptive fields never see a partial cache; if another worker renamed first, its cache is used.
+        parent_dir = os.path.dirname(cache_dir)
+        os.makedirs(parent_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.tmp_rf_')
+        groups = {}
+        for idx, (group, rf) in enumerate(receptive_fields.items()):
+            if group == 'input_space':
+                np.save(os.path.join(tmp_dir, 'input_space.npy'), rf)
+                continue
+            groups[group] = f'rf_{idx}.npz'
+            save_npz(os.path.join(tmp_dir, groups[group]), csr_matrix(rf))
+        manifest = {'connection_filename' : os.path.basename(connection_filename), 'groups' : groups}
+        with open(os.path.join(tmp_dir, cls.manifest_name), 'w') as fi:
+            json.dump(manifest, fi, indent=1)
+
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            # cache_dir exists and is not empty
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not cls.exists(cache_dir):
+                raise
+        return cls(cache_dir)
+
+    @classmethod
+    def exists(cls, cache_dir):
+        return os.path.isfile(os.path.join(cache_dir, cls.manifest_name))
+
+    def __getitem__(self, group):
+        if group not in self._loaded:
+            if group == 'input_space':
+                self._loaded[group] = np.load(os.path.join(self.cache_dir, 'input_space.npy'))
+            else:
+                self._loaded[group] = load_npz(os.path.join(self.cache_dir, self.manifest['groups'][group])).tocsr()
+        return self._loaded[group]
+
+    def __iter__(self):
+        yield 'input_space'
+        yield from self.manifest['groups']
+
+    def __len__(self):
+        return len(self.manifest['groups']) + 1
+
 class InternalModel:
-    if sys.platform is 'linux':
+    if sys.platform == 'linux':
         root_path = r'/opt2/Laskenta_ssd/Models/SchwabeModel/ASF_cont_bio'
     elif sys.platform.startswith('win'):
         root_path = r'C:\Users\Simo\Laskenta\Models\SchwabeModel\data_pikkuveljeltä\ASF_ConSearch'
@@ -20,81 +238,59 @@ class InternalModel:
     ng_name = 'NG1_SS_L2'
     input_group_prefix = 'NG0'
     myformat = 'eps'
+    # Save receptive fields next to the connections file, see ReceptiveFieldCache
+    use_rf_cache = True
 
-    def __init__(self, ng_name='',filename='',show_neuron_idx=None, savefigname=None):
+    def __init__(self, ng_name='',filename='',show_neuron_idx=None, savefigname=None, path=None, compute=True):
 
         if not ng_name:
             ng_name = self.ng_name
         if not filename:
             filename = self.filename
+        if not path:
+            path = self.root_path
 
         self.show_neuron_idx = show_neuron_idx
         self.savefigname = savefigname
-        self.get_internal_image(ng_name,filename,self.root_path)
+        # With compute=False, use the methods directly, eg get_internal_images for many files
+        if compute:
+            self.get_internal_image(ng_name,filename,path)
     
-    def _get_group_names_from_suffix(self, suffixes, all_group_names):
-        group_names_list = []
-        for suffix in suffixes:
-            for group in all_group_names:
-                if group[group.find('_') + 1:] in suffix:
-                    group_names_list.append(group)
-
-        return group_names_list
+    def analyze_groups(self, all_group_names, connection_data, connection_graph=None):
 
-    def analyze_groups(self, all_group_names, connection_data):
+        if connection_graph is None:
+            connection_graph = ConnectionGraph(connection_data, all_group_names)
 
         input_group_name = [group for group in all_group_names if group.startswith(self.input_group_prefix)][0]
-        
-        # Find first order groups
-        input_name_prefix = input_group_name[input_group_name.find('_') +1 :] 
-        # First_order_connections
-        connection_names = connection_data.keys()
-        first_order_connections = [conn for conn in connection_names if conn.startswith(input_name_prefix)]
-
-        first_order_group_suffix = [conn[conn.find('__to__') + 6:] for conn in first_order_connections]
-
-        first_order_groups_list = self._get_group_names_from_suffix(first_order_group_suffix, all_group_names)
-        
-        first_order_name_prefix = [ group[group.find('_') +1 :] for group in first_order_groups_list]
-
-        # build dict of second order connections
-        all_second_order_connections_dict = {}
-        for this_prefix in first_order_name_prefix:
-            second_order_connections4this_prefix = [conn for conn in connection_names if conn.startswith(this_prefix)]
-            all_second_order_connections_dict[this_prefix]=second_order_connections4this_prefix
-
-        second_order_suffix = []
-        for this_first_order_group in all_second_order_connections_dict.keys():
-            for this_connection in all_second_order_connections_dict[this_first_order_group]:
-                if this_connection.count(this_first_order_group) > 1:
-                    continue
-                elif 'autoconn' in this_connection:
-                    continue
-                else:
-                    suffix_name =this_connection[this_connection.find('__to__') + 6:]
-                    second_order_suffix.append(suffix_name)
-
-        second_order_groups_list = self._get_group_names_from_suffix(second_order_suffix, all_group_names)
-
-        second_order_connections_dict = {}
-        # Get incoming connections for each second order group
-        for s_group in second_order_groups_list:
-            for f_group in first_order_groups_list:
 
-                candidate_connection = f_group[f_group.find('_') + 1 :] + '__to__' + s_group[s_group.find('_') + 1 :]
-
-                valid_connections=[conn for conn in connection_names if conn.startswith(candidate_connection)]
-                second_order_connections_dict[s_group] = valid_connections
+        # Groups by their lowest order from input, and their incoming connections from the previous order
+        order_groups, order_connections = connection_graph.get_orders(input_group_name, max_order=2)
+        first_order_groups_list = order_groups[1] if len(order_groups) > 1 else []
+        second_order_groups_list = order_groups[2] if len(order_groups) > 2 else []
+        first_order_connections_dict = order_connections[1] if len(order_connections) > 1 else {}
+        second_order_connections_dict = order_connections[2] if len(order_connections) > 2 else {}
 
         group_analysis_dict = {
             'input' : input_group_name,
             'first_order' : first_order_groups_list,
             'second_order' : second_order_groups_list,
-            'first_order_connections' : first_order_connections,
+            'first_order_connections' : [c for g in first_order_groups_list for c in first_order_connections_dict[g]],
+            'first_order_connections_dict' : first_order_connections_dict,
             'second_order_connections_dict' : second_order_connections_dict
             }
         return group_analysis_dict
 
+    def _scale_to_max(self, conn_mx):
+        # Sparse copy of connection matrix scaled to max 1
+        conn_mx = csr_matrix(conn_mx, dtype=float)
+        # Empty matrices, eg fully pruned RFs, have no max
+        if conn_mx.nnz == 0:
+            return conn_mx
+        conn_max = conn_mx.max()
+        if conn_max == 0:
+            return conn_mx
+        return conn_mx * (1 / conn_max)
+
     def show_rf(self, receptive_fields, ng_name, show_neuron_idx=None, internal_image=None):
             
         input_space = receptive_fields['input_space']
@@ -111,17 +307,19 @@ class InternalModel:
 
         if show_neuron_idx:
             conn_scaled = receptive_fields[ng_name]
-            z = conn_scaled[show_neuron_idx,:].todense()
+            # Only the shown row is made dense
+            z = conn_scaled[show_neuron_idx,:].toarray()
             plt.title(f'Receptive field for neuron {show_neuron_idx} in group {ng_name}') 
 
         else:
             z = internal_image
             plt.title(f'Internal image for group {ng_name}') 
 
-
+        # 1 x IN images stay 2-D for imshow
+        z = np.atleast_2d(np.asarray(z))
         z_max = np.max(z)
 
-        h = plt.imshow(z.squeeze(), cmap ='Greys', vmin = 0, vmax = z_max, 
+        h = plt.imshow(z, cmap ='Greys', vmin = 0, vmax = z_max, 
                         extent =[xmin, xmax, ymin, ymax], 
                             interpolation ='nearest', origin='lower') 
         plt.colorbar(h) 
@@ -137,10 +335,22 @@ class InternalModel:
         # In case of second order neurons, get the first-level RF first, then use them to get the
         # second level weights. w_coord is cortical coordinates, z_coord is visual field coordinates.
 
-        connection_filename = simulation_filename.replace('results','connections')
+        connection_filename = getConnectionsFilename(simulation_filename)
+        assert connection_filename is not None, 'Connections file not found'
+
+        # Cached receptive fields skip both loading the connections and the matrix products
+        if self.use_rf_cache:
+            cache_dir = ReceptiveFieldCache.get_cache_dir(connection_filename, all_group_names, self.input_group_prefix)
+            if ReceptiveFieldCache.exists(cache_dir):
+                receptive_fields = ReceptiveFieldCache(cache_dir)
+                if self.show_neuron_idx and ng_name is not None:
+                    self.show_rf(receptive_fields, ng_name, self.show_neuron_idx)
+                return receptive_fields
+
         connection_data = getData(connection_filename)
 
-        group_analysis_dict = self.analyze_groups(all_group_names, connection_data)
+        connection_graph = get_connection_graph(connection_filename, connection_data, all_group_names)
+        group_analysis_dict = self.analyze_groups(all_group_names, connection_data, connection_graph=connection_graph)
 
         positions_input = connection_data['positions_all']['z_coord'][group_analysis_dict['input']]
         input_space = np.asarray(positions_input)
@@ -148,47 +358,190 @@ class InternalModel:
         receptive_fields = {}
         receptive_fields['input_space'] = input_space
 
-        # Get first order connection rf:s
-        for group, connection in zip(group_analysis_dict['first_order'], group_analysis_dict['first_order_connections']):
-
-            conn_mx = connection_data[connection]['data']
-            conn_mx_scaled = conn_mx / np.max(conn_mx)
-            receptive_fields[group] = np.transpose(conn_mx_scaled)
+        # Get first order connection rf:s. All matrices stay sparse.
+        for group in group_analysis_dict['first_order']:
+            # Connections to several compartments of the same group are summed
+            rf1 = None
+            for connection in group_analysis_dict['first_order_connections_dict'][group]:
+                conn_mx_scaled = self._scale_to_max(connection_data[connection]['data']).T.tocsr()
+                rf1 = conn_mx_scaled if rf1 is None else rf1 + conn_mx_scaled
+            receptive_fields[group] = self._scale_to_max(rf1)
 
         # Get second order connection rf:s
         for group in group_analysis_dict['second_order']:
             connections = group_analysis_dict['second_order_connections_dict'][group]
             
-            rf2 = np.zeros([1, 1])
+            rf2 = None
             for connection in connections:
                 # Matrices are M1 = G1 x IN and M2 = G1 x G2. The correct calculation
                 # is M2.T * M1, after which you get M3 = G2 x IN dimension
 
-                G1_name_stub = connection[:connection.find('__to__')]
-                G1_name = [g for g in receptive_fields.keys() if g.endswith(G1_name_stub)]
-                M1 = receptive_fields[G1_name[0]]
+                M1 = receptive_fields[connection_graph.get_source(connection)]
                 
                 # Scale second order connection
-                conn_mx = connection_data[connection]['data']
-                M2 = conn_mx / np.max(conn_mx)
+                M2 = self._scale_to_max(connection_data[connection]['data'])
 
-                M3 = np.dot(np.transpose(M2), M1)
+                M3 = M2.T.tocsr() @ M1
 
-                try: 
-                    rf2 += M3
-                except UnboundLocalError: 
-                    rf2 = M3 
+                rf2 = M3 if rf2 is None else rf2 + M3
 
+            if rf2 is None:
+                continue
             # multiply with first order connections RF 2nd = sigma (Conn 2nd * RF 1st)
-            receptive_fields[group] = csr_matrix(rf2 / np.max(rf2))
+            receptive_fields[group] = self._scale_to_max(rf2)
+
+        if self.use_rf_cache:
+            receptive_fields = ReceptiveFieldCache.save(cache_dir, receptive_fields, connection_filename)
 
-        if self.show_neuron_idx:
+        # ng_name None only computes the receptive fields
+        if self.show_neuron_idx and ng_name is not None:
             show_neuron_idx = self.show_neuron_idx
             self.show_rf(receptive_fields, ng_name, show_neuron_idx)
         
         return receptive_fields
 
 
+    def _prune(self, rf, top_k=None, threshold=None, max_nnz=None):
+        # Keep per row top_k values, values at least threshold x max, and at most max_nnz largest values.
+        # max_nnz <= 0 drops all values. Returns pruned csr matrix, which may be empty.
+        rf = csr_matrix(rf)
+        rf.eliminate_zeros()
+        keep = np.ones(rf.nnz, dtype=bool)
+        if threshold is not None and rf.nnz:
+            keep &= rf.data >= threshold * rf.data.max()
+        if top_k is not None:
+            row_ids = np.repeat(np.arange(rf.shape[0]), np.diff(rf.indptr))
+            order = np.lexsort((-rf.data, row_ids))
+            rank = np.empty(rf.nnz, dtype=np.int64)
+            rank[order] = np.arange(rf.nnz) - rf.indptr[row_ids[order]]
+            keep &= rank < top_k
+        if max_nnz is not None and max_nnz <= 0:
+            keep[:] = False
+        elif max_nnz is not None and keep.sum() > max_nnz:
+            kept_positions = np.flatnonzero(keep)
+            largest = np.argpartition(-rf.data[kept_positions], max_nnz - 1)[:max_nnz]
+            keep[:] = False
+            keep[kept_positions[largest]] = True
+        if keep.all():
+            return rf
+        pruned = rf.copy()
+        pruned.data = np.where(keep, pruned.data, 0)
+        pruned.eliminate_zeros()
+        return pruned
+
+    def _propagate_order(self, connection_graph, conn_transposed, edge_ids, input_id, order, previous_rfs):
+        # Order k RFs, sum of (Conn S->G).T * order k-1 RF of S over the edges to each group G except input
+        order_rfs = {}
+        for edge_idx in edge_ids:
+            source = connection_graph.edge_sources[edge_idx]
+            target = connection_graph.edge_targets[edge_idx]
+            if target == input_id:
+                continue
+            if order == 1:
+                if source != input_id:
+                    continue
+                contribution = conn_transposed[edge_idx]
+            elif source in previous_rfs:
+                contribution = conn_transposed[edge_idx] @ previous_rfs[source]
+            else:
+                continue
+            order_rfs[target] = contribution if target not in order_rfs else order_rfs[target] + contribution
+        return order_rfs
+
+    def _combine_rfs(self, combined_rfs, target, rf, combine):
+        if combine == 'sum':
+            combined_rfs[target] = rf if target not in combined_rfs else combined_rfs[target] + rf
+        elif combine == 'first':
+            combined_rfs.setdefault(target, rf)
+        else:
+            raise NotImplementedError(f'Unknown combine {combine}, valid are sum and first')
+
+    def get_rf_nth_order(self, all_group_names, simulation_filename, max_order=3, top_k=None, threshold=None, 
+                            max_nnz=None, exclude_autoconn=True, combine='sum', exact_error=True):
+        '''
+        Receptive fields propagated over the connection graph up to max_order connections from input. 
+        Order k RF of group G is sigma (Conn S->G).T * order k-1 RF of S over all connections to G, scaled 
+        to max 1. Unlike get_rf, groups can be reached again at higher orders, and with exclude_autoconn=False
+        also through autoconn loops.
+
+        After each order, each RF is pruned to top_k largest values per neuron, to values above threshold x max,
+        and to max_nnz largest values, which keeps the sparse products from filling in. The returned RFs are
+        pruned once more after combining the orders, thus they, too, are within top_k and max_nnz.
+
+        combine='sum' returns for each group the scaled sum of its RFs over all orders, combine='first' the RF
+        of the lowest order reaching it. Returns receptive_fields dict (G x IN csr and 'input_space') and report,
+        list of dicts with order, group, nnz, density and relative_error (Frobenius norm of the difference 
+        relative to the norm of the reference). Entries for each order give the error of pruning that order,
+        relative to the unpruned product of the pruned previous order. Entries with order 'combined' describe 
+        the returned RFs, with the error relative to the RFs propagated without pruning. The unpruned RFs are
+        propagated only for this error, and only with exact_error=True, otherwise the error is NaN.
+        '''
+        connection_filename = getConnectionsFilename(simulation_filename)
+        assert connection_filename is not None, 'Connections file not found'
+        connection_data = getData(connection_filename)
+        connection_graph = get_connection_graph(connection_filename, connection_data, all_group_names)
+
+        input_group_name = [group for group in all_group_names if group.startswith(self.input_group_prefix)][0]
+        input_id = connection_graph.group_ids[input_group_name]
+        valid = connection_graph.get_edges(exclude_autoconn=exclude_autoconn, exclude_self=exclude_autoconn)
+        edge_ids = np.flatnonzero(valid)
+
+        # Scaled connection matrices, transposed to target x source
+        conn_transposed = {}
+        for edge_idx in edge_ids:
+            connection = connection_graph.edge_names[edge_idx]
+            conn_transposed[edge_idx] = self._scale_to_max(connection_data[connection]['data']).T.tocsr()
+        input_space = np.asarray(connection_data['positions_all']['z_coord'][input_group_name])
+        del connection_data
+
+        propagation_args = (connection_graph, conn_transposed, edge_ids, input_id)
+        report = []
+        previous_rfs, previous_exact_rfs = {}, {}
+        combined_rfs, combined_exact_rfs = {}, {}
+        for order in range(1, max_order + 1):
+            order_rfs = self._propagate_order(*propagation_args, order, previous_rfs)
+            if not order_rfs:
+                break
+            for target, rf in order_rfs.items():
+                rf = self._scale_to_max(rf)
+                pruned = self._prune(rf, top_k=top_k, threshold=threshold, max_nnz=max_nnz)
+                report.append({
+                    'order' : order,
+                    'group' : connection_graph.group_names[target],
+                    'nnz' : pruned.nnz,
+                    'density' : pruned.nnz / (pruned.shape[0] * pruned.shape[1]),
+                    'relative_error' : _get_relative_error(rf, pruned),
+                    })
+                order_rfs[target] = pruned
+                self._combine_rfs(combined_rfs, target, pruned, combine)
+            previous_rfs = order_rfs
+
+            if exact_error:
+                exact_order_rfs = self._propagate_order(*propagation_args, order, previous_exact_rfs)
+                for target, rf in exact_order_rfs.items():
+                    exact_order_rfs[target] = self._scale_to_max(rf)
+                    self._combine_rfs(combined_exact_rfs, target, exact_order_rfs[target], combine)
+                previous_exact_rfs = exact_order_rfs
+
+        receptive_fields = {'input_space' : input_space}
+        for target, rf in combined_rfs.items():
+            # The sum over orders can exceed the budget of each order
+            rf = self._prune(self._scale_to_max(rf), top_k=top_k, threshold=threshold, max_nnz=max_nnz)
+            receptive_fields[connection_graph.group_names[target]] = rf
+            if exact_error:
+                relative_error = _get_relative_error(self._scale_to_max(combined_exact_rfs[target]), rf)
+            else:
+                relative_error = np.nan
+            report.append({
+                'order' : 'combined',
+                'group' : connection_graph.group_names[target],
+                'nnz' : rf.nnz,
+                'density' : rf.nnz / (rf.shape[0] * rf.shape[1]),
+                'relative_error' : relative_error,
+                })
+
+        return receptive_fields, report
+
     def get_internal_image(self, ng_name,simulation_filename,path):
         # Pick neuron group, get rf for each neuron, weigh the rf with response rate from simulation. 
         # Show internal image
@@ -203,12 +556,209 @@ class InternalModel:
         receptive_fields = self.get_rf(ng_name, all_group_names, full_filepath)
 
         # laske sisäiset edustukset alla kertomalla rf:t aktiivisuuksilla
-        ng_spike_freq_data = data['spikes_all'][ng_name]['count'] / simulation_time
+        ng_spike_freq_data = np.asarray(data['spikes_all'][ng_name]['count'], dtype=float) / float(simulation_time)
         ng_receptive_fields = receptive_fields[ng_name]
-        ng_spikes = np.dot(ng_spike_freq_data, ng_receptive_fields.todense())
-        internal_image = ng_spikes / np.max(ng_spikes)
+        # Sparse G x IN transposed times dense G rates, only the IN image is dense
+        ng_spikes = ng_receptive_fields.T @ ng_spike_freq_data
+        internal_image = (ng_spikes / np.max(ng_spikes))[np.newaxis, :]
 
         self.show_rf(receptive_fields, ng_name, internal_image=internal_image)
+
+    def get_internal_movie(self, ng_name, simulation_filename, path, bin_length=0.01, output_filename=None, 
+                            max_chunk_size=2**22, fps=10, vmax=None):
+        '''
+        Internal image as function of time. Spikes are binned to bin_length (s) rates, and chunks of 
+        time bins x G rates are multiplied by the sparse RF, so that at most max_chunk_size elements of frames 
+        are in memory at a time. Frames [time bins, IN] are written to output_filename, .npy as memory-mapped
+        float32 array (default results filename with _internal_<ng_name>.npy), or a video file (eg .mp4 or 
+        .gif) through matplotlib animation writers, with color scale 0 to vmax (default max over frames).
+        Returns output_filename.
+        '''
+        full_filepath = os.path.join(path, simulation_filename)
+        data = getData(full_filepath)
+        simulation_time = float(data['runtime'])
+        all_group_names = data['number_of_neurons'].keys()
+        assert ng_name in  all_group_names, 'Neuron group not found'
+
+        receptive_fields = self.get_rf(ng_name, all_group_names, full_filepath)
+        rf_transposed = receptive_fields[ng_name].T.tocsr()
+        n_in, n_neurons = rf_transposed.shape
+
+        if output_filename is None:
+            output_filename = os.path.splitext(full_filepath)[0] + f'_internal_{ng_name}.npy'
+
+        # Spikes in time order, chunks are then contiguous slices
+        t = np.asarray(data['spikes_all'][ng_name]['t'], dtype=float)
+        i = np.asarray(data['spikes_all'][ng_name]['i'], dtype=np.int64)
+        time_order = np.argsort(t, kind='stable')
+        t, i = t[time_order], i[time_order]
+        del data
+
+        n_bins = int(np.ceil(simulation_time / bin_length))
+        n_bins_per_chunk = max(1, int(max_chunk_size // max(n_in, n_neurons)))
+        # Bins once for all spikes, the same bins define the chunks. Spikes at the end go to the last bin.
+        spike_bins = np.minimum((t / bin_length).astype(np.int64), n_bins - 1)
+        del t
+
+        def _frame_chunks():
+            for bin_start in range(0, n_bins, n_bins_per_chunk):
+                bin_end = min(bin_start + n_bins_per_chunk, n_bins)
+                spike_start, spike_end = np.searchsorted(spike_bins, [bin_start, bin_end])
+                chunk_bins = spike_bins[spike_start:spike_end] - bin_start
+                counts = np.bincount(chunk_bins * n_neurons + i[spike_start:spike_end], 
+                                    minlength=(bin_end - bin_start) * n_neurons).reshape(-1, n_neurons)
+                rates = counts / bin_length
+                # IN x G sparse times G x bins dense
+                yield bin_start, bin_end, np.asarray(rf_transposed @ rates.T).T
+
+        if output_filename.endswith('.npy'):
+            frames = np.lib.format.open_memmap(output_filename, mode='w+', dtype=np.float32, shape=(n_bins, n_in))
+            for bin_start, bin_end, frame_chunk in _frame_chunks():
+                frames[bin_start:bin_end, :] = frame_chunk
+            frames.flush()
+            del frames
+            return output_filename
+
+        # Video. Color scale needs the max over all frames first.
+        if vmax is None:
+            vmax = max(np.max(frame_chunk) for foo, bar, frame_chunk in _frame_chunks())
+        from matplotlib import animation
+        input_space = receptive_fields['input_space']
+        y, x = np.imag(input_space), np.real(input_space)
+        xmin, xmax = (0, 1) if np.ptp(x) == 0 else (x.min(), x.max())
+        ymin, ymax = (0, 1) if np.ptp(y) == 0 else (y.min(), y.max())
+
+        fig = plt.figure()
+        h = plt.imshow(np.zeros((1, n_in)), cmap ='Greys', vmin = 0, vmax = vmax, extent =[xmin, xmax, ymin, ymax], 
+                        interpolation ='nearest', origin='lower')
+        plt.colorbar(h)
+        title = plt.title('')
+        if output_filename.endswith('.gif'):
+            writer = animation.PillowWriter(fps=fps)
+        else:
+            writer = animation.FFMpegWriter(fps=fps)
+        with writer.saving(fig, output_filename, dpi=100):
+            for bin_start, bin_end, frame_chunk in _frame_chunks():
+                for frame_idx, frame in enumerate(frame_chunk):
+                    h.set_data(frame[np.newaxis, :])
+                    title.set_text(f'Internal image for group {ng_name}, t = {(bin_start + frame_idx) * bin_length:.3f} s')
+                    writer.grab_frame()
+        plt.close(fig)
+        return output_filename
+
+    def get_internal_images(self, filenames, ng_names=None, path=None, n_workers=None):
+        '''
+        Internal images of ng_names (default all groups with RF) for many results files. Files sharing a
+        connections file share the RFs, and their rates are stacked to files x neurons matrix, so that
+        each group needs one sparse-dense product. Results files are read in a process pool of n_workers.
+
+        Returns dict with
+            'filenames' : results filenames, rows of the images
+            'ng_names' : neuron groups
+            'input_space' : positions of the input group, columns of the images
+            'images' : dict with internal images [files, IN] for each group, each row scaled to max 1
+        '''
+        if path is not None:
+            filenames = [os.path.join(path, f) for f in filenames]
+
+        # Rates of groups with spike monitor, G vector for each file and group
+        group_names_list = [None] * len(filenames)
+        rates_list = [None] * len(filenames)
+        for file_index, (group_names, rates_dict) in _mapFilesInPool(_get_rates_worker, filenames, n_workers=n_workers):
+            group_names_list[file_index] = group_names
+            rates_list[file_index] = rates_dict
+
+        connection_filenames = [getConnectionsFilename(f) for f in filenames]
+        assert None not in connection_filenames, 'Connections file not found'
+
+        images = {}
+        input_space = None
+        for connection_filename in sorted(set(connection_filenames)):
+            file_indices = [idx for idx, c in enumerate(connection_filenames) if c == connection_filename]
+            all_group_names = group_names_list[file_indices[0]]
+            receptive_fields = self.get_rf(None, all_group_names, filenames[file_indices[0]])
+            if input_space is None:
+                input_space = receptive_fields['input_space']
+            assert len(input_space) == len(receptive_fields['input_space']), 'Input spaces differ between connections files'
+
+            if ng_names is None:
+                ng_names = [g for g in all_group_names if g in receptive_fields]
+            for ng_name in ng_names:
+                # Skip groups without RF, and files without spike monitor for the group
+                if ng_name not in receptive_fields:
+                    continue
+                file_indices_with_rates = [idx for idx in file_indices if ng_name in rates_list[idx]]
+                if not file_indices_with_rates:
+                    continue
+                # files x G rates, then IN x files image by one product
+                rates = np.stack([rates_list[idx][ng_name] for idx in file_indices_with_rates])
+                ng_images = np.asarray(receptive_fields[ng_name].T @ rates.T).T
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    ng_images = ng_images / np.max(ng_images, axis=1, keepdims=True)
+                if ng_name not in images:
+                    images[ng_name] = np.full((len(filenames), len(input_space)), np.nan)
+                images[ng_name][file_indices_with_rates, :] = ng_images
+
+        return {
+            'filenames' : filenames,
+            'ng_names' : [g for g in ng_names if g in images],
+            'input_space' : input_space,
+            'images' : images
+            }
+
+    def render_internal_images(self, internal_images, output_path, n_workers=None):
+        '''
+        Save each image of get_internal_images output to output_path, named by results file and group,
+        in a process pool of n_workers. Returns the figure filenames.
+        '''
+        os.makedirs(output_path, exist_ok=True)
+        tasks = []
+        for ng_name in internal_images['ng_names']:
+            for filename, image in zip(internal_images['filenames'], internal_images['images'][ng_name]):
+                basename = os.path.splitext(os.path.basename(filename))[0]
+                figure_filename = os.path.join(output_path, f'{basename}_internal_{ng_name}.{self.myformat}')
+                tasks.append((image, internal_images['input_space'], f'Internal image for group {ng_name}', figure_filename))
+
+        if not tasks:
+            return []
+        if n_workers == 1:
+            return [_render_image(*task) for task in tasks]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(_render_image, *zip(*tasks)))
+
+def _get_relative_error(reference, approximation):
+    # Frobenius norm of the difference of sparse matrices relative to the norm of reference, 0 for zero reference
+    reference_norm = np.sqrt(reference.multiply(reference).sum())
+    difference = reference - approximation
+    error_norm = np.sqrt(difference.multiply(difference).sum())
+    return error_norm / reference_norm if reference_norm > 0 else 0.
+
+def _get_rates_worker(filename):
+    # All group names, and mean firing rate of each neuron of the groups with spike monitor in results file
+    data = getData(filename)
+    simulation_time = float(data['runtime'])
+    rates_dict = {ng_name : np.asarray(spikes['count'], dtype=float) / simulation_time 
+                    for ng_name, spikes in data['spikes_all'].items()}
+    return list(data['number_of_neurons'].keys()), rates_dict
+
+def _render_image(image, input_space, title, figure_filename):
+    # Internal image to file, as in show_rf
+    y, x = np.imag(input_space), np.real(input_space)
+    xmin, xmax = (0, 1) if np.ptp(x) == 0 else (x.min(), x.max())
+    ymin, ymax = (0, 1) if np.ptp(y) == 0 else (y.min(), y.max())
+    z = np.atleast_2d(image)
+    # Groups without spike monitor in this file have all-NaN images
+    finite_z = z[np.isfinite(z)]
+    z_max = finite_z.max() if finite_z.size else 1
+
+    fig = plt.figure()
+    h = plt.imshow(z, cmap ='Greys', vmin = 0, vmax = z_max, extent =[xmin, xmax, ymin, ymax], 
+                    interpolation ='nearest', origin='lower')
+    plt.colorbar(h)
+    plt.title(title)
+    fig.savefig(figure_filename)
+    plt.close(fig)
+    return figure_filename
         
 
 if __name__=='__main__':
@@ -0,0 +1,49 @@
+'''
+Load heavy modules on first use instead of at import time.
+
+    plt = LazyImport('matplotlib.pyplot')
+    read_config_file = LazyImport('cxsystem2.core.tools', 'read_config_file')
+
+The proxy imports the module, and optionally gets the attribute, at the first attribute access or call.
+'''
+
+import importlib
+
+
+class LazyImport:
+
+    def __init__(self, module_name, attribute_name=None):
+        # Set through __dict__, __getattr__ is only called for missing attributes
+        self.__dict__['_module_name'] = module_name
+        self.__dict__['_attribute_name'] = attribute_name
+        self.__dict__['_target'] = None
+
+    def _load(self):
+        target = self.__dict__['_target']
+        if target is None:
+            target = importlib.import_module(self._module_name)
+            if self._attribute_name is not None:
+                target = getattr(target, self._attribute_name)
+            self.__dict__['_target'] = target
+        return target
+
+    @property
+    def is_loaded(self):
+        return self.__dict__['_target'] is not None
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        name = self._module_name if self._attribute_name is None else f'{self._module_name}.{self._attribute_name}'
+        status = 'loaded' if self.is_loaded else 'not loaded'
+        return f'<LazyImport {name}, {status}>'
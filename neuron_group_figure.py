@@ -2,8 +2,9 @@ import os
 import matplotlib.pyplot as plt 
 import numpy as np
 import utilities as ut
+import group_interactions as gi
 
-TÄHÄN JÄIT. TEE KUVA JOSSA ROWS ON NG JA COLS ON PARAMS
+# TÄHÄN JÄIT. TEE KUVA JOSSA ROWS ON NG JA COLS ON PARAMS
 
 class showFigure:
 
@@ -22,15 +23,76 @@ class showFigure:
         self.ncols = vm + raster + spectrum + coherence + transfer_entropy
 
         # get data
-        self.data = ut.getData(os.path.join(showFigure.path_to_data, showFigure.filename))
+        self.full_filename = os.path.join(showFigure.path_to_data, showFigure.filename)
+        self.data = ut.getData(self.full_filename)
 
         # get visible rows
         self.neuron_groups = list(self.data['spikes_all'].keys())
         self.anat_config = self.data['Anatomy_configuration']
         self.nrows = len(self.neuron_groups)
-        
 
-    def passer(self):
+        # group interactions are computed on first use, see getInteractions and getTransferEntropy
+        self.interactions = None
+        self.te_dict = None
+
+    def getInteractions(self):
+        # coherence and cross-correlograms for all group pairs, cached per file
+        if self.interactions is None:
+            self.interactions = gi.getGroupInteractions(data=self.data, filename=self.full_filename, 
+                                                        neuron_groups=self.neuron_groups, freq_max=200)
+        return self.interactions
+
+    def getTransferEntropy(self):
+        # transfer entropy between group population trains, cached per file
+        if self.te_dict is None:
+            self.te_dict = gi.getTransferEntropy(data=self.data, filename=self.full_filename, 
+                                                neuron_groups=self.neuron_groups)
+        return self.te_dict
+
+    def show(self):
+        # grid of neuron groups (rows) and visible columns. Columns without implementation stay empty.
+        columns = [ (self.vm, 'vm', self.passer), (self.raster, 'raster', self.passer), 
+                    (self.spectrum, 'spectrum', self.passer), (self.coherence, 'coherence', self.showCoherence), 
+                    (self.transfer_entropy, 'transfer entropy', self.showTransferEntropy)]
+        columns = [(title, method) for visible, title, method in columns if visible]
+
+        fig, axs = plt.subplots(self.nrows, self.ncols, figsize=showFigure.figure_size, squeeze=False)
+        for row, neuron_group in enumerate(self.neuron_groups):
+            for col, (title, method) in enumerate(columns):
+                method(axs[row, col], neuron_group)
+                if row == 0:
+                    axs[row, col].set_title(title, fontsize=8)
+            axs[row, 0].set_ylabel(neuron_group, fontsize=8)
+        return fig
+
+    def showCoherence(self, ax, neuron_group):
+        # coherence of neuron_group with all other groups
+        interactions = self.getInteractions()
+        if neuron_group not in interactions['coherence_groups']:
+            return
+        group_idx = interactions['coherence_groups'].index(neuron_group)
+        for other_idx, other_group in enumerate(interactions['coherence_groups']):
+            if other_idx == group_idx:
+                continue
+            ax.plot(interactions['freqs'], interactions['coherence'][group_idx, other_idx, :], label=other_group)
+        ax.set_ylim(0, 1)
+        ax.legend(fontsize=6)
+
+    def showTransferEntropy(self, ax, neuron_group):
+        # transfer entropy from neuron_group to (dark) and from (light) all other groups
+        te_dict = self.getTransferEntropy()
+        labels = te_dict['labels']
+        te = te_dict['te']
+        group_idx = labels.index(neuron_group)
+        other_idx = [idx for idx in range(len(labels)) if idx != group_idx]
+        x = np.arange(len(other_idx))
+        ax.bar(x - 0.2, te[group_idx, other_idx], width=0.4, color='k')
+        ax.bar(x + 0.2, te[other_idx, group_idx], width=0.4, color='gray')
+        ax.set_xticks(x)
+        ax.set_xticklabels([labels[idx] for idx in other_idx], fontsize=6, rotation=90)
+
+
+    def passer(self, ax=None, neuron_group=None):
         pass
 
     def myData(self, pathname, filename):
@@ -42,6 +104,8 @@ def main():
     
     # print(type(myFig.anat_config))
     print(myFig.ncols, myFig.nrows)
+    myFig.show()
+    plt.show()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,310 @@
+'''
+Spike train statistics for all neurons and neuron groups: firing rates, interspike interval
+distributions, CV, Fano factor and population synchrony.
+
+Spikes of each group are sorted once to per-neuron layout (indptr + times), after which all
+statistics are computed with array operations over all neurons together. The layout is kept in
+SpikeIndex, which is saved to the cache folder next to the results file. Many result files are
+handled in a process pool, see getSpikeStatisticsForFiles.
+'''
+
+import numpy as np
+import os
+from utilities import getData, _mapFilesInPool, CACHE_FOLDER_NAME
+
+
+def _getSpikeTrains(neuron_indices, spike_times, n_neurons):
+    '''
+    Sort spikes by neuron and, within neuron, by time. Returns indptr [n_neurons + 1] and times, so that
+    the spikes of neuron k are times[indptr[k]:indptr[k + 1]].
+    '''
+    neuron_indices = np.asarray(neuron_indices, dtype=np.int64)
+    spike_times = np.asarray(spike_times, dtype=float)
+    order = np.lexsort((spike_times, neuron_indices))
+    counts = np.bincount(neuron_indices, minlength=n_neurons)
+    indptr = np.zeros(n_neurons + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, spike_times[order]
+
+class SpikeIndex:
+    '''
+    Spikes of all neuron groups of one results file, sorted by neuron and, within neuron, by time.
+    Spikes of neuron k in group are times[group][indptr[group][k]:indptr[group][k + 1]]. Indices are 
+    int32 and times float32 seconds. Optionally spikes are also kept in time order, times with the 
+    neuron index of each spike, for time window queries over all neurons.
+
+    Build with SpikeIndex.fromData or getSpikeIndex, which saves the index next to the results file.
+    '''
+
+    # Arrays saved for each neuron group
+    fields = ('indptr', 'times', 'sorted_times', 'sorted_neurons')
+
+    def __init__(self, indptr, times, sorted_times=None, sorted_neurons=None, runtime=None):
+        # indptr, times, and optional time sorted times and neuron indices are dicts with an array for each neuron group
+        self.indptr = indptr
+        self.times = times
+        self.sorted_times = sorted_times if sorted_times is not None else {}
+        self.sorted_neurons = sorted_neurons if sorted_neurons is not None else {}
+        self.runtime = runtime
+
+    @classmethod
+    def fromData(cls, data, time_sorted=True):
+        indptr = {}
+        times = {}
+        sorted_times = {}
+        sorted_neurons = {}
+        for neuron_group, spikes in data['spikes_all'].items():
+            n_neurons = len(spikes['count'])
+            group_indptr, group_times = _getSpikeTrains(spikes['i'], spikes['t'], n_neurons)
+            indptr[neuron_group] = group_indptr.astype(np.int32)
+            times[neuron_group] = group_times.astype(np.float32)
+            if time_sorted:
+                time_order = np.argsort(times[neuron_group], kind='stable')
+                sorted_times[neuron_group] = times[neuron_group][time_order]
+                sorted_neurons[neuron_group] = _getNeuronIds(indptr[neuron_group])[time_order].astype(np.int32)
+        if 'runtime' in data:
+            runtime = float(np.asarray(data['runtime']))
+        else:
+            # Without runtime, the recording ends at the last spike
+            runtime = max([float(t.max()) for t in times.values() if len(t)], default=0.)
+        return cls(indptr, times, sorted_times, sorted_neurons, runtime=runtime)
+
+    @classmethod
+    def load(cls, filename):
+        arrays = {field : {} for field in cls.fields}
+        runtime = None
+        with np.load(filename, allow_pickle=False) as npz:
+            for key in npz.files:
+                if key == 'runtime':
+                    runtime = float(npz[key])
+                    continue
+                neuron_group, field = key.rsplit('__', 1)
+                if field in arrays:
+                    arrays[field][neuron_group] = npz[key]
+        return cls(**arrays, runtime=runtime)
+
+    def save(self, filename):
+        arrays = {}
+        for field in self.fields:
+            for neuron_group, array in getattr(self, field).items():
+                arrays[f'{neuron_group}__{field}'] = array
+        if self.runtime is not None:
+            arrays['runtime'] = np.asarray(self.runtime)
+        os.makedirs(os.path.dirname(filename) or './', exist_ok=True)
+        np.savez(filename, **arrays)
+
+    @property
+    def neuron_groups(self):
+        return list(self.indptr.keys())
+
+    def n_neurons(self, neuron_group):
+        return len(self.indptr[neuron_group]) - 1
+
+    def spikes(self, neuron_group, neuron_index):
+        # Spike times of one neuron, a view to the index
+        indptr = self.indptr[neuron_group]
+        return self.times[neuron_group][indptr[neuron_index]:indptr[neuron_index + 1]]
+
+    def _windowBounds(self, neuron_group, t_start, t_end):
+        # Window bounds in the dtype of the stored times. A spike on the dt grid at 0.7 s is stored as 
+        # float32(0.7), which is below float64 0.7 and would drop out of the window starting at 0.7 s.
+        return np.array([t_start, t_end], dtype=self.times[neuron_group].dtype)
+
+    def spikesInWindow(self, neuron_group, neuron_index, t_start, t_end):
+        # Spike times t_start <= t < t_end of one neuron, by binary search
+        neuron_times = self.spikes(neuron_group, neuron_index)
+        start, end = np.searchsorted(neuron_times, self._windowBounds(neuron_group, t_start, t_end))
+        return neuron_times[start:end]
+
+    def countsInWindow(self, neuron_group, t_start, t_end):
+        # Spike counts t_start <= t < t_end of all neurons
+        n_neurons = self.n_neurons(neuron_group)
+        window = self._windowBounds(neuron_group, t_start, t_end)
+        if neuron_group in self.sorted_times:
+            start, end = np.searchsorted(self.sorted_times[neuron_group], window)
+            neuron_ids = self.sorted_neurons[neuron_group][start:end]
+        else:
+            times = self.times[neuron_group]
+            spike_positions = np.flatnonzero((times >= window[0]) & (times < window[1]))
+            neuron_ids = np.searchsorted(self.indptr[neuron_group], spike_positions, side='right') - 1
+        return np.bincount(neuron_ids, minlength=n_neurons)
+
+    def neuronIds(self, neuron_group):
+        # Neuron index of each spike in times[neuron_group]
+        return _getNeuronIds(self.indptr[neuron_group])
+
+def _getSpikeIndexFilename(filename):
+    path, basename = os.path.split(filename)
+    return os.path.join(path, CACHE_FOLDER_NAME, os.path.splitext(basename)[0] + '_spike_index.npz')
+
+def getSpikeIndex(filename, data=None, use_cache=True):
+    '''
+    SpikeIndex for results file. The index is saved to the cache folder next to the results file and
+    loaded from there, unless the results file has changed. Pass data if already loaded.
+    '''
+    index_filename = _getSpikeIndexFilename(filename)
+    if use_cache and os.path.isfile(index_filename) and os.path.getmtime(index_filename) >= os.path.getmtime(filename):
+        spike_index = SpikeIndex.load(index_filename)
+        # Indices saved before time sorted spikes were stored are rebuilt
+        if spike_index.sorted_times or not spike_index.indptr:
+            return spike_index
+
+    if data is None:
+        data = getData(filename)
+    spike_index = SpikeIndex.fromData(data)
+    if use_cache:
+        spike_index.save(index_filename)
+    return spike_index
+
+def _getNeuronIds(indptr):
+    # Neuron index of each spike in the sorted layout
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+def _binnedCountMoments(neuron_ids, bin_ids, n_neurons, n_bins):
+    '''
+    Mean and variance over bins of spike counts, per neuron, without the dense [bins, neurons] count
+    matrix. Only (bin, neuron) pairs with spikes are counted, the rest are zeros.
+    '''
+    keys, counts = np.unique(bin_ids * n_neurons + neuron_ids, return_counts=True)
+    key_neurons = keys % n_neurons
+    sum_counts = np.bincount(key_neurons, weights=counts, minlength=n_neurons)
+    sum_squares = np.bincount(key_neurons, weights=counts.astype(float) ** 2, minlength=n_neurons)
+    mean = sum_counts / n_bins
+    variance = sum_squares / n_bins - mean ** 2
+    return mean, np.maximum(variance, 0)
+
+def getISIStatistics(indptr, times, isi_bins=None, time_range=None):
+    '''
+    Interspike intervals of all neurons, between spikes within time_range (default all). Returns dict with 
+    mean ISI, ISI standard deviation and CV (NaN for neurons with less than two intervals) for each neuron, 
+    and ISI histogram over all neurons with isi_bins edges (default 50 log-spaced bins from 1 ms to 10 s).
+    '''
+    n_neurons = len(indptr) - 1
+    neuron_ids = _getNeuronIds(indptr)
+    if time_range is not None:
+        in_range = (times >= time_range[0]) & (times < time_range[1])
+        neuron_ids, times = neuron_ids[in_range], times[in_range]
+    isi = np.diff(times)
+    # Intervals between the last spike of one neuron and the first spike of next are not intervals
+    is_isi = neuron_ids[1:] == neuron_ids[:-1]
+    isi = isi[is_isi]
+    isi_neuron_ids = neuron_ids[1:][is_isi]
+
+    n_isi = np.bincount(isi_neuron_ids, minlength=n_neurons)
+    sum_isi = np.bincount(isi_neuron_ids, weights=isi, minlength=n_neurons)
+    sum_squares = np.bincount(isi_neuron_ids, weights=isi ** 2, minlength=n_neurons)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_isi = sum_isi / n_isi
+        std_isi = np.sqrt(np.maximum(sum_squares / n_isi - mean_isi ** 2, 0))
+        cv = std_isi / mean_isi
+    cv[n_isi < 2] = np.nan
+
+    if isi_bins is None:
+        isi_bins = np.logspace(-3, 1, 51)
+    isi_histogram, isi_edges = np.histogram(isi, bins=isi_bins)
+
+    return {
+        'mean_isi' : mean_isi,
+        'std_isi' : std_isi,
+        'cv' : cv,
+        'isi_histogram' : isi_histogram,
+        'isi_edges' : isi_edges,
+        }
+
+def getFanoFactor(indptr, times, window_length=0.1, time_range=None):
+    '''
+    Fano factor (variance / mean of spike counts in consecutive windows of window_length seconds within
+    time_range) for each neuron. NaN for silent neurons.
+    '''
+    n_neurons = len(indptr) - 1
+    if time_range is None:
+        time_range = (0, times.max() if times.size else window_length)
+    # Small tolerance, 2.0 // 0.1 is 19 in floating point
+    n_windows = max(1, int(np.floor((time_range[1] - time_range[0]) / window_length + 1e-9)))
+    window_ids = np.floor((times - time_range[0]) / window_length).astype(np.int64)
+    neuron_ids = _getNeuronIds(indptr)
+    # Spikes outside full windows are not counted
+    in_range = (window_ids >= 0) & (window_ids < n_windows)
+    mean, variance = _binnedCountMoments(neuron_ids[in_range], window_ids[in_range], n_neurons, n_windows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fano_factor = variance / mean
+    return fano_factor
+
+def getSynchrony(indptr, times, bin_length=0.005, time_range=None):
+    '''
+    Population synchrony chi (Golomb 2007): square root of the variance of the population mean spike count
+    over bins of bin_length seconds, normalized by the mean of single neuron count variances. 0 for
+    independent and 1 for fully synchronized neurons. NaN if no spikes.
+    '''
+    n_neurons = len(indptr) - 1
+    if time_range is None:
+        time_range = (0, times.max() if times.size else bin_length)
+    n_bins = max(1, int(np.ceil((time_range[1] - time_range[0]) / bin_length)))
+    bin_ids = np.floor((times - time_range[0]) / bin_length).astype(np.int64)
+    neuron_ids = _getNeuronIds(indptr)
+    in_range = (bin_ids >= 0) & (bin_ids < n_bins)
+    bin_ids = bin_ids[in_range]
+
+    foo, neuron_variances = _binnedCountMoments(neuron_ids[in_range], bin_ids, n_neurons, n_bins)
+    population_signal = np.bincount(bin_ids, minlength=n_bins) / n_neurons
+    mean_neuron_variance = np.mean(neuron_variances)
+    if mean_neuron_variance == 0:
+        return np.nan
+    return np.sqrt(np.var(population_signal) / mean_neuron_variance)
+
+def getSpikeStatistics( data=None, filename=None, neuron_groups=None, time_range=None, fano_window=0.1,
+                        synchrony_bin=0.005, isi_bins=None, use_cache=True):
+    '''
+    Spike statistics for neuron groups (default all groups in spikes_all) of one results file, given either
+    as data dict or filename. Times are in seconds, time_range defaults to 0 to runtime. With filename, 
+    the spike index is read from cache when available, see getSpikeIndex.
+
+    Returns dict with one dict for each neuron group:
+        'n_neurons' : number of neurons
+        'rates' : firing rate in Hz for each neuron within time_range
+        'mean_isi', 'std_isi', 'cv' : ISI mean, standard deviation and coefficient of variation for each neuron,
+                                        from spikes within time_range
+        'isi_histogram', 'isi_edges' : ISI distribution over all neurons
+        'fano_factor' : Fano factor of fano_window counts for each neuron
+        'synchrony' : population synchrony chi with synchrony_bin bins
+    '''
+    if filename is None:
+        spike_index = SpikeIndex.fromData(data)
+    else:
+        spike_index = getSpikeIndex(filename, data=data, use_cache=use_cache)
+    if neuron_groups is None:
+        neuron_groups = spike_index.neuron_groups
+    if time_range is None:
+        time_range = (0, spike_index.runtime)
+
+    statistics = {}
+    for neuron_group in neuron_groups:
+        n_neurons = spike_index.n_neurons(neuron_group)
+        indptr = spike_index.indptr[neuron_group]
+        times = spike_index.times[neuron_group].astype(float)
+
+        # Rates count only spikes within time_range
+        rates = spike_index.countsInWindow(neuron_group, *time_range) / (time_range[1] - time_range[0])
+
+        group_statistics = {'n_neurons' : n_neurons, 'rates' : rates}
+        group_statistics.update(getISIStatistics(indptr, times, isi_bins=isi_bins, time_range=time_range))
+        group_statistics['fano_factor'] = getFanoFactor(indptr, times, window_length=fano_window, time_range=time_range)
+        group_statistics['synchrony'] = getSynchrony(indptr, times, bin_length=synchrony_bin, time_range=time_range)
+        statistics[neuron_group] = group_statistics
+
+    return statistics
+
+def _getSpikeStatisticsWorker(filename, kwargs):
+    # Module level function for the process pool
+    return getSpikeStatistics(filename=filename, **kwargs)
+
+def getSpikeStatisticsForFiles(filenames, n_workers=None, max_in_flight=None, **kwargs):
+    '''
+    getSpikeStatistics for many results files in a process pool of n_workers. Keyword arguments are
+    passed to getSpikeStatistics. Returns list of statistics dicts in the order of filenames.
+    '''
+    statistics_list = [None] * len(filenames)
+    for file_index, statistics in _mapFilesInPool(  _getSpikeStatisticsWorker, filenames, worker_args=(kwargs,),
+                                                    n_workers=n_workers, max_in_flight=max_in_flight):
+        statistics_list[file_index] = statistics
+    return statistics_list
@@ -0,0 +1,76 @@
+'''
+Import time benchmark. Each module is imported in a fresh interpreter, repeats times, and the fastest
+import is compared to the budget. Fails, with exit code 1, if a module is over budget or if it imports
+any of the heavy modules which should be loaded only on first use.
+
+Usage, eg
+    python startup_benchmark.py
+    python startup_benchmark.py --modules utilities --budget 0.5 --repeats 5
+'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Seconds, fastest of the repeats
+DEFAULT_BUDGETS = {
+    'utilities' : 1.0,
+    'CxConstructor' : 1.5,
+    }
+
+HEAVY_MODULES = ['brian2', 'matplotlib.pyplot', 'cxsystem2', 'elephant', 'neo', 'quantities']
+
+_IMPORT_CODE = '''
+import sys, time, json
+t_start = time.perf_counter()
+import {module}
+t_import = time.perf_counter() - t_start
+print(json.dumps({{'time' : t_import, 'heavy' : [m for m in {heavy} if m in sys.modules]}}))
+'''
+
+def measureImport(module, repeats=3, heavy_modules=HEAVY_MODULES):
+    '''
+    Import module in repeats fresh interpreters, in this directory. Returns fastest import time in seconds
+    and the heavy modules the import loaded.
+    '''
+    code = _IMPORT_CODE.format(module=module, heavy=repr(list(heavy_modules)))
+    times = []
+    heavy_loaded = set()
+    for repeat in range(repeats):
+        completed = subprocess.run( [sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True, check=True)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        times.append(result['time'])
+        heavy_loaded.update(result['heavy'])
+    return min(times), sorted(heavy_loaded)
+
+def runBenchmark(budgets=None, repeats=3, heavy_modules=HEAVY_MODULES):
+    # Returns True if all modules are within budget and do not import heavy modules
+    if budgets is None:
+        budgets = DEFAULT_BUDGETS
+    all_passed = True
+    for module, budget in budgets.items():
+        import_time, heavy_loaded = measureImport(module, repeats=repeats, heavy_modules=heavy_modules)
+        passed = import_time <= budget and not heavy_loaded
+        all_passed &= passed
+        status = 'OK' if passed else 'FAIL'
+        print(f'{status:4} {module:20} {import_time:6.3f} s (budget {budget:.3f} s)', end='')
+        print(f', imports {", ".join(heavy_loaded)}' if heavy_loaded else '')
+    return all_passed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fail if module import time is over budget')
+    parser.add_argument('--modules', nargs='+', default=None, help='Modules, default utilities and CxConstructor')
+    parser.add_argument('--budget', type=float, default=None, help='Budget in seconds for all modules')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    modules = args.modules if args.modules else list(DEFAULT_BUDGETS.keys())
+    budgets = {m : args.budget if args.budget is not None else DEFAULT_BUDGETS.get(m, 1.0) for m in modules}
+    return 0 if runBenchmark(budgets, repeats=args.repeats) else 1
+
+
+if __name__=='__main__':
+    sys.exit(main())
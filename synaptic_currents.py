@@ -0,0 +1,205 @@
+'''
+Synaptic currents from monitored vm, ge and gi, in plain float arrays (SI units).
+
+The time window and neuron subset are sliced before any arithmetic, and the currents are computed
+in place, so the full recordings are never copied. Leak and reversal potentials come from the
+physiology configuration saved in the results file.
+'''
+
+import importlib.util
+import warnings
+from collections import ChainMap
+import numpy as np
+
+# brian2 is loaded on first use, for the units of the physiology configuration
+from lazy_import import LazyImport
+brian2 = LazyImport('brian2')
+allunits = LazyImport('brian2.units.allunits')
+
+# Used when the physiology configuration is missing from the results file or does not define the value
+DEFAULT_PARAMETERS = {'El' : -65e-3, 'gl' : 50e-9, 'Ee' : 0., 'Ei' : -75e-3}
+
+# Mapping from our parameter names to the physiology configuration keys
+PHYSIOLOGY_KEYS = {'El' : 'EL', 'gl' : 'gL', 'Ee' : 'Ee', 'Ei' : 'Ei'}
+
+# Names in physiology configuration expressions, see _getNamespace
+_namespace = None
+
+
+def _isFilled(value):
+    return isinstance(value, str) and bool(value.strip())
+
+def _getNamespace():
+    # CxSystem2 evaluates the physiology configuration after from brian2 import *. The prefixed units which 
+    # brian2 does not export, eg uV, come from brian2.units.allunits. Empty without brian2, in which case 
+    # no value with units can be evaluated.
+    global _namespace
+    if _namespace is None:
+        _namespace = {}
+        if importlib.util.find_spec('brian2') is not None:
+            for module in [allunits, brian2]:
+                _namespace.update({name : getattr(module, name) for name in dir(module) if not name.startswith('_')})
+    return _namespace
+
+def _evaluate(expression, namespace):
+    # Evaluate one configuration value, None if it cannot be evaluated
+    try:
+        return eval(expression, {'__builtins__' : {}}, namespace)
+    except Exception:
+        return None
+
+def _toSI(value):
+    # brian2 quantities to SI floats or float arrays, recursively in dicts
+    if isinstance(value, dict):
+        return {key : _toSI(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        value = np.asarray(value, dtype=float)
+        return float(value) if value.ndim == 0 else value
+    return value
+
+def getPhysiologyParameters(physiology_df):
+    '''
+    Evaluate the physiology configuration dataframe (Variable, Key, Value columns, as in CxSystem2
+    physiology csv) with the brian2 units to SI floats. 
+    
+    Variable,,Value rows become parameters. Variable,Key,Value rows, followed by ,Key,Value rows, become 
+    dicts, which include both global dicts, eg reversal_potentials, and neuron type sections, eg 'SS'. 
+    Keys inside a dict may refer to earlier keys of the same dict, eg taum_soma = C/gL. 
+    Values which cannot be evaluated are None.
+    '''
+    rows = [row[:3] for row in np.asarray(physiology_df, dtype=object)]
+
+    namespace = _getNamespace()
+    parameters = {}
+    current_variable = None
+    for variable, key, value in rows:
+        if variable == 'Variable' or (_isFilled(variable) and variable.strip().startswith('#')):
+            continue
+
+        if _isFilled(variable):
+            current_variable = variable.strip()
+            if not _isFilled(key):
+                if str(value).strip() not in ('', 'nan'):
+                    parameters[current_variable] = _evaluate(str(value), ChainMap(parameters, namespace))
+                else:
+                    # Section without parameters, eg VPM
+                    parameters[current_variable] = {}
+                continue
+            parameters[current_variable] = {}
+
+        if _isFilled(key) and isinstance(parameters.get(current_variable), dict):
+            this_dict = parameters[current_variable]
+            this_dict[key.strip()] = _evaluate(str(value), ChainMap(this_dict, parameters, namespace))
+
+    # Quantities are kept until all values are evaluated, since later values refer to them
+    return _toSI(parameters)
+
+def _getNeuronTypeParameters(parameters, neuron_group):
+    # Neuron group names are 'NG<idx>_<neuron_subtype>_<layer>', eg 'NG1_SS_L2' or 'NG3_L4_PC1_L4toL1', and
+    # physiology sections are named by neuron subtype. Take the longest section name which is a prefix of
+    # the group name without 'NG<idx>_', ending at '_'. None if there is no matching section.
+    name = neuron_group[neuron_group.find('_') + 1:] if neuron_group.startswith('NG') else neuron_group
+    matching_sections = [   section_name for section_name, section in parameters.items() 
+                            if isinstance(section, dict) and (name == section_name or name.startswith(section_name + '_'))]
+    if not matching_sections:
+        return None
+    return parameters[max(matching_sections, key=len)]
+
+def _getLeakConductance(section):
+    # Compartmental neurons, eg PC, have specific gL [S/m2]. The soma leak is gL times soma area.
+    gL = section.get('gL')
+    if 'fract_areas' not in section or not isinstance(gL, (int, float)):
+        return gL
+    fract_areas = section['fract_areas']
+    if not isinstance(fract_areas, dict) or not isinstance(section.get('Area_tot_pyram'), (int, float)):
+        return None
+    # fract_areas arrays are basal dendrite, soma, apical dendrites
+    soma_fraction = float(list(fract_areas.values())[0][1])
+    return gL * section['Area_tot_pyram'] * soma_fraction
+
+def getCurrentParameters(data, neuron_group, physiology_parameters=None):
+    '''
+    Leak conductance gl and leak, excitatory and inhibitory reversal potentials El, Ee, Ei for neuron_group
+    (eg 'NG1_SS_L2') from the physiology configuration in data. Values missing from the configuration are 
+    taken from DEFAULT_PARAMETERS, with a warning. Pass physiology_parameters from getPhysiologyParameters to 
+    avoid parsing the configuration again.
+    '''
+    parameters = dict(DEFAULT_PARAMETERS)
+    if physiology_parameters is None:
+        if 'Physiology_configuration' not in data:
+            warnings.warn(f'No physiology configuration in data, using default parameters for {neuron_group}')
+            return parameters
+        physiology_parameters = getPhysiologyParameters(data['Physiology_configuration'])
+
+    this_group_parameters = _getNeuronTypeParameters(physiology_parameters, neuron_group)
+    if this_group_parameters is None:
+        warnings.warn(f'No physiology section for {neuron_group}, using default parameters')
+        return parameters
+
+    missing_names = []
+    for name, physiology_key in PHYSIOLOGY_KEYS.items():
+        if name == 'gl':
+            value = _getLeakConductance(this_group_parameters)
+        else:
+            value = this_group_parameters.get(physiology_key)
+        if isinstance(value, (int, float)):
+            parameters[name] = float(value)
+        else:
+            missing_names.append(name)
+    if missing_names:
+        warnings.warn(f'Using default {", ".join(missing_names)} for {neuron_group}, not found in physiology configuration')
+
+    return parameters
+
+def getCurrents(data, neuron_groups=None, time_interval=None, neuron_indices=None, physiology_parameters=None):
+    '''
+    Leak, excitatory, inhibitory and total currents, in amperes, for neuron groups (default all groups
+    with vm, ge_soma and gi_soma monitored). Only samples time_interval[0]:time_interval[1] (default all)
+    and neuron columns neuron_indices (default all; array, or dict with an array for each group) are used.
+    physiology_parameters from getPhysiologyParameters are parsed from data if not given.
+
+    Returns dict with {'I_total', 'I_excitatory', 'I_inhibitory'} arrays [time, neurons] for each group.
+    '''
+    if neuron_groups is None:
+        neuron_groups = [n for n in data['vm_all'].keys() if n in data['ge_soma_all'] and n in data['gi_soma_all']]
+    if time_interval is None:
+        time_slice = slice(None)
+    else:
+        time_slice = slice(time_interval[0], time_interval[1])
+
+    if physiology_parameters is None and 'Physiology_configuration' in data:
+        physiology_parameters = getPhysiologyParameters(data['Physiology_configuration'])
+
+    currents_dict = {}
+    for neuron_group in neuron_groups:
+        if isinstance(neuron_indices, dict):
+            columns = neuron_indices.get(neuron_group, slice(None))
+        elif neuron_indices is None:
+            columns = slice(None)
+        else:
+            columns = neuron_indices
+
+        # Slice before arithmetic. np.asarray strips brian2 units, leaving SI values
+        vm = np.asarray(data['vm_all'][neuron_group]['vm'])[time_slice, columns]
+        ge = np.asarray(data['ge_soma_all'][neuron_group]['ge_soma'])[time_slice, columns]
+        gi = np.asarray(data['gi_soma_all'][neuron_group]['gi_soma'])[time_slice, columns]
+
+        parameters = getCurrentParameters(data, neuron_group, physiology_parameters=physiology_parameters)
+
+        # I_total = gl * (El - vm) + ge * (Ee - vm) + gi * (Ei - vm)
+        I_excitatory = np.subtract(parameters['Ee'], vm, dtype=float)
+        I_excitatory *= ge
+        I_inhibitory = np.subtract(parameters['Ei'], vm, dtype=float)
+        I_inhibitory *= gi
+        I_total = np.subtract(parameters['El'], vm, dtype=float)
+        I_total *= parameters['gl']
+        I_total += I_excitatory
+        I_total += I_inhibitory
+
+        currents_dict[neuron_group] = {
+            'I_total' : I_total,
+            'I_excitatory' : I_excitatory,
+            'I_inhibitory' : I_inhibitory
+            }
+
+    return currents_dict
@@ -0,0 +1,24 @@
+import numpy as np
+from spike_statistics import SpikeIndex
+
+def _getGridData():
+    # Two neurons spiking on a 0.1 ms dt grid, the first of them at 0.7 s and 0.8 s
+    dt = 0.0001
+    spike_steps = np.array([7000, 7500, 8000, 6999, 7000, 7999])
+    data = {'spikes_all' : {'NG1_SS_L2' : { 'i' : np.array([0, 0, 0, 1, 1, 1]), 
+                                            't' : spike_steps * dt, 
+                                            'count' : np.array([3, 3])}},
+            'runtime' : 1.0}
+    return data
+
+def test_spikes_in_window_includes_start_on_dt_grid():
+    spike_index = SpikeIndex.fromData(_getGridData())
+    spikes = spike_index.spikesInWindow('NG1_SS_L2', 0, 0.7, 0.8)
+    assert np.allclose(spikes, [0.7, 0.75])
+
+def test_counts_in_window_includes_start_on_dt_grid():
+    data = _getGridData()
+    for time_sorted in [True, False]:
+        spike_index = SpikeIndex.fromData(data, time_sorted=time_sorted)
+        counts = spike_index.countsInWindow('NG1_SS_L2', 0.7, 0.8)
+        assert counts.tolist() == [2, 2]
@@ -1,20 +1,43 @@
 import zlib
 import pickle
+import hashlib
+import importlib.util
+import io
 import numpy as np
-from matplotlib import pyplot as plt
-from scipy import sparse
-import scipy.io as sio
 import os
+import re
 import sys
-from cxsystem2.core.tools import write_to_file as wtf
-from brian2.units import *
 import datetime
-import pandas as pd
-import elephant as el
-from neo.core import AnalogSignal
-import quantities as pq
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import pdb
 
+# Heavy dependencies are imported on first use, see startup_benchmark.py
+from lazy_import import LazyImport
+plt = LazyImport('matplotlib.pyplot')
+sparse = LazyImport('scipy.sparse')
+cKDTree = LazyImport('scipy.spatial', 'cKDTree')
+welch = LazyImport('scipy.signal', 'welch')
+sio = LazyImport('scipy.io')
+pd = LazyImport('pandas')
+wtf = LazyImport('cxsystem2.core.tools', 'write_to_file')
+
+from synaptic_currents import getCurrents, getCurrentParameters, getPhysiologyParameters
+
+CACHE_FOLDER_NAME = 'cache'
+
+# Above this many spikes, rasters are drawn as spike count images
+RASTER_MAX_N_SPIKES = 100000
+
+# Above this many samples, traces are drawn as min/max envelopes of this many points
+TRACE_MAX_N_POINTS = 4000
+
+# Spatial indices of neuron group positions, at most this many are kept, keyed by this many sampled 
+# positions, see _getPositionIndex
+POSITION_INDEX_CACHE_SIZE = 32
+POSITION_INDEX_KEY_SAMPLES = 256
+_position_index_cache = OrderedDict()
+
 def parsePath(path,filename, type='results'):
     filename_out = None
     if path is None:
@@ -54,18 +77,39 @@ def figsave(figurename='', myformat='png', suffix=''):
         transparent=False, bbox_inches=None, pad_inches=0.1,
         metadata=None)
 
-def getData(filename):
+class _PlainUnpickler(pickle.Unpickler):
+    # Unpickles brian2 Quantities as plain float arrays in SI units, without importing brian2
+    def find_class(self, module, name):
+        if module.startswith('brian2'):
+            if name == 'quantity_with_dimensions':
+                return lambda value, dims: np.asarray(value)
+            if name == 'get_or_create_dimension':
+                return lambda *args, **kwargs: None
+            raise pickle.UnpicklingError(f'Cannot unpickle {module}.{name} without brian2')
+        return super().find_class(module, name)
+
+def _loadPickle(fi, plain_arrays):
+    if plain_arrays:
+        return _PlainUnpickler(fi).load()
+    return pickle.load(fi)
+
+def getData(filename, plain_arrays=None):
 
     # If extension is .gz, open pickle, else assume .mat
+    # With plain_arrays, brian2 quantities are read as float arrays in SI units, without importing brian2.
+    # Default is plain arrays only when brian2 is not installed.
+    if plain_arrays is None:
+        plain_arrays = importlib.util.find_spec('brian2') is None
     filename_root, filename_extension = os.path.splitext(filename)
     if 'gz' in filename_extension:
-        fi = open(filename, 'rb')
+        with open(filename, 'rb') as fi:
+            file_content = fi.read()
         try:
-            data_pickle = zlib.decompress(fi.read())
-            data = pickle.loads(data_pickle)
-        except:
-            with open(filename, 'rb') as data_pickle:
-                data = pickle.load(data_pickle)
+            data_pickle = zlib.decompress(file_content)
+        except zlib.error:
+            # Uncompressed pickle
+            data_pickle = file_content
+        data = _loadPickle(io.BytesIO(data_pickle), plain_arrays)
     elif 'mat' in filename_extension:
         data = {}
         sio.loadmat(filename,data) 
@@ -74,47 +118,160 @@ def getData(filename):
 
     return data
 
-def _getDistance(positions,index_position=None):
+def _getCacheFilename(path, cache_name):
+    # Derived data is cached to the cache folder under the data path. The folder name does not match
+    # the 'results' or 'connections' filename searches.
+    return os.path.join(path, CACHE_FOLDER_NAME, cache_name + '.gz')
+
+def _saveCache(cache_filename, data):
+    # Same zlib compressed pickle as the CxSystem2 data files, thus getData reads it back
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    with open(cache_filename, 'wb') as fi:
+        fi.write(zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+
+def _loadCache(cache_filename, source_filenames=()):
+    # Returns None if the cache does not exist or if any of the source files has changed after caching
+    if not os.path.isfile(cache_filename):
+        return None
+    cache_mtime = os.path.getmtime(cache_filename)
+    if any(os.path.getmtime(f) > cache_mtime for f in source_filenames):
+        return None
+    return getData(cache_filename)
+
+def _getDistance(positions,index_position=None, max_block_size=2**22):
     '''Calculates distances between neurons. If index position is given, 
     only distances to this neuron is calculated. Without index position, 
     all distance pairs will be calculated.
-    Assumes positions as a list or numpy array of complex coordinates'''
+    Assumes positions as a list or numpy array of complex coordinates.
+    The all pairs matrix is calculated in blocks of rows with at most max_block_size elements each, 
+    to keep the temporary arrays small. For large groups, use getNeighborsWithinRadius or 
+    getNearestNeighbors instead, they do not need the N x N matrix.'''
     
     positions_array = np.asarray(positions)
     assert len(positions_array) > 1, 'At least two positions necessary for distance'
 
-    # Calculate distance btw one cell and all other cells
-    def dist(index_position,other_positions):
-        # Assumes arrays of complex numbers
-        d = np.sqrt((np.real(index_position)-np.real(other_positions))**2 + 
-            (np.imag(index_position)-np.imag(other_positions))**2)
-        return d
-
     # Check whether index_position exists
     if index_position is not None:
         # Calculate distance between index neuron and other neurons
-        distance = dist(index_position,positions_array)
+        distance = _dist(index_position,positions_array)
     # If only two positions are given
     elif len(positions_array)==2:
-        distance = dist(positions_array[0],positions_array[1])
+        distance = _dist(positions_array[0],positions_array[1])
     # Otherwise
     else:
         # Init result matrix
-        distance = np.zeros([len(positions_array),len(positions_array)])
-
-        # Loop index neuron positions
-        for idx, index_position in enumerate(positions_array):
-            ## Create vector array of other positions
-            #other_positions = np.hstack([positions_array[:idx],positions_array[idx+1:]]) 
-            # Calculate distance between index neuron and all neurons including itself
-            distance[idx,:] = dist(index_position,positions_array)
+        distance = np.empty([len(positions_array),len(positions_array)])
+        for row_start, distance_block in _iterDistanceBlocks(positions_array, positions_array, max_block_size=max_block_size):
+            distance[row_start:row_start + distance_block.shape[0],:] = distance_block
            
     return distance
 
-def _getNeuronIndex(data, neuron_group, position=0+0j):
-    neuron_index=data['positions_all']['w_coord'][neuron_group].index(position)
+def _dist(index_position,other_positions):
+    # Calculate distance btw one cell and all other cells. Assumes arrays of complex numbers
+    d = np.sqrt((np.real(index_position)-np.real(other_positions))**2 + 
+        (np.imag(index_position)-np.imag(other_positions))**2)
+    return d
+
+def _iterDistanceBlocks(positions, other_positions, max_block_size=2**22):
+    # Yields (row_start, distance_block) where distance_block has distances from a block of 
+    # positions to all other_positions. Rows per block are set by max_block_size elements.
+    positions = np.asarray(positions)
+    other_positions = np.asarray(other_positions)
+    n_rows_per_block = max(1, int(max_block_size // max(1, len(other_positions))))
+    for row_start in range(0, len(positions), n_rows_per_block):
+        row_block = positions[row_start:row_start + n_rows_per_block]
+        yield row_start, _dist(row_block[:,np.newaxis], other_positions[np.newaxis,:])
+
+def _getKDTree(positions):
+    # KD tree from complex positions
+    positions = np.asarray(positions)
+    return cKDTree(np.column_stack((np.real(positions), np.imag(positions))))
+
+def getNeighborsWithinRadius(positions, radius, other_positions=None):
+    '''
+    Distances from positions to other_positions (default positions) within radius, as sparse csr matrix 
+    of shape [len(positions), len(other_positions)]. Zero distances, eg a neuron to itself, are stored 
+    as explicit zeros. Uses a KD tree, thus memory grows with the number of neighbors, not with N x N.
+    Assumes complex coordinates.
+    '''
+    tree = _getKDTree(positions)
+    if other_positions is None:
+        other_tree = tree
+    else:
+        other_tree = _getKDTree(other_positions)
+    distance_coo = tree.sparse_distance_matrix(other_tree, radius, output_type='coo_matrix')
+    return distance_coo.tocsr()
+
+def getNearestNeighbors(positions, k=1, query_positions=None):
+    '''
+    Distances and indices of the k nearest positions for each query position (default positions, 
+    in which case each neuron is its own nearest neighbor). Returns two arrays of shape [N queries, k],
+    sorted by increasing distance. Assumes complex coordinates.
+    '''
+    if query_positions is None:
+        query_positions = positions
+    query_positions = np.asarray(query_positions)
+    tree = _getKDTree(positions)
+    distances, indices = tree.query(np.column_stack((np.real(query_positions), np.imag(query_positions))), k=k)
+    return distances.reshape(len(query_positions), k), indices.reshape(len(query_positions), k)
+
+class _PositionIndex:
+    '''
+    Spatial index for the complex positions of one neuron group. Lookups go through a KD tree, 
+    thus they tolerate floating point drift in the coordinates and do not scan the positions.
+    '''
+    def __init__(self, positions):
+        self.positions = np.asarray(positions)
+        self.tree = _getKDTree(self.positions)
+
+    def nearest(self, query_positions):
+        # Distances and indices of the nearest neuron for each query position
+        query_positions = np.atleast_1d(np.asarray(query_positions))
+        distances, indices = self.tree.query(np.column_stack((np.real(query_positions), np.imag(query_positions))))
+        return distances, indices
+
+    def index(self, position, tolerance=1e-6):
+        # Like list.index, but accepts positions within tolerance
+        distances, indices = self.nearest(position)
+        if distances[0] > tolerance:
+            raise ValueError(f'No neuron at position {position}, nearest is {distances[0]} away')
+        return int(indices[0])
+
+def _getPositionsKey(positions):
+    # Number of positions and an evenly strided sample of them, including the last one. All files of one 
+    # run have the same positions, thus the same key, and making the key does not scan the positions.
+    n_positions = len(positions)
+    step = max(n_positions // POSITION_INDEX_KEY_SAMPLES, 1)
+    sample = np.asarray(list(positions[::step]) + list(positions[-1:]), dtype=np.complex128)
+    return n_positions, hashlib.sha1(sample.tobytes()).hexdigest()
+
+def _getPositionIndex(data, neuron_group, coords='w_coord'):
+    # The index is built once for each distinct set of positions and kept in a small LRU cache, so the 
+    # next file of the same run, eg in ASF analysis, finds the index ready.
+    positions = data['positions_all'][coords][neuron_group]
+    cache_key = (coords, neuron_group) + _getPositionsKey(positions)
+    if cache_key not in _position_index_cache:
+        _position_index_cache[cache_key] = _PositionIndex(positions)
+        while len(_position_index_cache) > POSITION_INDEX_CACHE_SIZE:
+            _position_index_cache.popitem(last=False)
+    _position_index_cache.move_to_end(cache_key)
+    return _position_index_cache[cache_key]
+
+def _getNeuronIndex(data, neuron_group, position=0+0j, coords='w_coord', tolerance=1e-6):
+    # Index of the neuron at position. Raises ValueError if there is no neuron within tolerance.
+    position_index = _getPositionIndex(data, neuron_group, coords=coords)
+    neuron_index = position_index.index(position, tolerance=tolerance)
     return neuron_index
 
+def _getNeuronIndices(data, neuron_group, positions, coords='w_coord', tolerance=None):
+    # Batched lookup, returns array of neuron indices nearest to positions. With tolerance, 
+    # raises ValueError if any of the positions is farther than tolerance from its nearest neuron.
+    position_index = _getPositionIndex(data, neuron_group, coords=coords)
+    distances, neuron_indices = position_index.nearest(positions)
+    if tolerance is not None and np.any(distances > tolerance):
+        raise ValueError(f'{np.sum(distances > tolerance)} positions have no neuron within {tolerance}')
+    return neuron_indices
+
 def getLambda(D,MF):
     # Length constant according to Schwabe et al J Neurosci 2006
     # D is diameter of mean axonal length in mm along cx.
@@ -123,7 +280,15 @@ def getLambda(D,MF):
     l = -1 * delta_x**-1 * np.log(0.05)
     return l
 
-def _createPositions(distance_between_neurons, cx_radius, ndims=2, coordinate_system='w', zero_first=False):
+def _createPositions(distance_between_neurons, cx_radius, ndims=2, coordinate_system='w', zero_first=False,
+                        grid='square', jitter=0., seed=None, dtype=np.complex128):
+    '''
+    Create neuron positions inside a circle of cx_radius, in complex coordinates. 
+    The grid is 'square' or 'hexagonal'. Jitter moves each neuron except the center by a uniform random 
+    displacement up to +-jitter/2 times the grid step along each axis. Positions are generated row by row 
+    inside the circle, thus memory grows with the number of neurons, not with the bounding square.
+    Returns numpy array of dtype (complex128 or complex64).
+    '''
     
     # Define grid. Put RF center to index 0.
     n_neurons_per_row = int(np.ceil((2 * cx_radius) / distance_between_neurons))
@@ -132,37 +297,71 @@ def _createPositions(distance_between_neurons, cx_radius, ndims=2, coordinate_sy
          n_neurons_per_row += 1
     center_position = 0+0j # assuming center at 0+0j
     
+    # Grid step along rows. The square grid is the same as linspace(-cx_radius,cx_radius,n_neurons_per_row)
+    # along both axes
+    positions_real = np.linspace(-cx_radius,cx_radius,n_neurons_per_row)
+    step = positions_real[1] - positions_real[0] if n_neurons_per_row > 1 else distance_between_neurons
+
     if ndims==2:
-        # Assuming circular grid, n rows = n columns
-        n_neurons_per_column = n_neurons_per_row
-        positions_real = np.linspace(-cx_radius,cx_radius,n_neurons_per_row)
-        positions_imag = np.linspace(-cx_radius,cx_radius,n_neurons_per_column)
+        if grid=='square':
+            # Assuming circular grid, n rows = n columns
+            positions_imag = positions_real
+        elif grid=='hexagonal':
+            row_step = step * np.sqrt(3) / 2
+            n_half_rows = int(np.floor(cx_radius / row_step))
+            positions_imag = np.arange(-n_half_rows, n_half_rows + 1) * row_step
+        else:
+            raise NotImplementedError('Unknown grid, valid grids are square and hexagonal')
     elif ndims==1:
-        positions_real = np.linspace(-cx_radius,cx_radius,n_neurons_per_row)
         #Place all cells to y=0
-        positions_imag = 0
+        positions_imag = np.array([0.])
     else:
         raise NotImplementedError('Number of dimensions is not 1 or 2')
-    
-    
-    positions_grid = np.meshgrid(positions_real,positions_imag)
-    positions_grid[1] = positions_grid[1] * 1j
-    positions_grid_np_array = positions_grid[0] + positions_grid[1]
-    positions_grid_np_array_flat = positions_grid_np_array.flatten()
+
+    # Find the range of grid columns for each row which might fall within the circle. One extra column 
+    # at both ends, the exact cut is done below.
+    half_widths = np.sqrt(np.maximum(cx_radius**2 - positions_imag**2, 0))
+    if grid=='hexagonal' and ndims==2:
+        # Odd rows are shifted half step
+        row_numbers = np.round(positions_imag / row_step).astype(int)
+        row_offsets = np.mod(row_numbers, 2) * 0.5
+        first_columns = np.ceil(-half_widths / step - row_offsets).astype(int) - 1
+        last_columns = np.floor(half_widths / step - row_offsets).astype(int) + 1
+    else:
+        row_offsets = np.zeros(len(positions_imag))
+        first_columns = np.maximum(np.floor((cx_radius - half_widths) / step).astype(int) - 1, 0)
+        last_columns = np.minimum(np.ceil((cx_radius + half_widths) / step).astype(int) + 1, n_neurons_per_row - 1)
+    n_columns = last_columns - first_columns + 1
+
+    # Expand rows to positions
+    row_indices = np.repeat(np.arange(len(positions_imag)), n_columns)
+    column_indices = first_columns[row_indices] + np.arange(row_indices.size) - np.repeat(np.cumsum(n_columns) - n_columns, n_columns)
+    if grid=='hexagonal' and ndims==2:
+        x = (column_indices + row_offsets[row_indices]) * step
+    else:
+        x = positions_real[column_indices]
+    y = positions_imag[row_indices]
 
     # Cut circle according to cx_radius distance
-    distances_to_center = _getDistance(positions_grid_np_array_flat, index_position=center_position)
-    positions = positions_grid_np_array.flatten()[distances_to_center<=cx_radius]
+    inside_circle = _dist(center_position, x + 1j * y) <= cx_radius
+    positions = x[inside_circle] + 1j * y[inside_circle]
+
+    if jitter:
+        rng = np.random.default_rng(seed)
+        is_center = positions == center_position
+        displacement = rng.uniform(-jitter/2, jitter/2, (2, positions.size)) * step
+        if ndims==1:
+            displacement[1,:] = 0
+        positions = positions + np.where(is_center, 0, displacement[0] + 1j * displacement[1])
 
     if zero_first:
         # Find center
-        center_index_tuple=np.where(positions == center_position)
-        assert len(center_index_tuple) == 1, 'Other than 1 values equal center value'
-        center_index = int(center_index_tuple[0])
-        positions_zero_first = np.hstack((positions[center_index],
-                                        positions[:center_index],
-                                        positions[center_index+1:]))
-        positions=positions_zero_first
+        center_index_array = np.flatnonzero(positions == center_position)
+        assert len(center_index_array) == 1, 'Other than 1 values equal center value'
+        center_index = center_index_array[0]
+        positions = np.concatenate((positions[center_index:center_index+1],
+                                    positions[:center_index],
+                                    positions[center_index+1:]))
 
     if coordinate_system=='z':
         # magnification factor at 5 deg according to Schwabe 2006
@@ -174,12 +373,10 @@ def _createPositions(distance_between_neurons, cx_radius, ndims=2, coordinate_sy
     else:
         raise NotImplementedError('Unknown coordinate system')
 
-    positions_out=[(pos) for pos in positions] 
-
     # Return positions in complex coordinates
-    return positions_out
+    return positions.astype(dtype)
 
-def buildSchwabePositions(ndims=1,group_keys=None,group_values=None):
+def buildSchwabePositions(ndims=1,group_keys=None,group_values=None, grid='square', jitter=0., seed=None, dtype=np.complex128):
     
     # Three first groups are in V1 (161 neurons) and the fourth is in V5 (33)
     if group_keys is None or group_values is None:
@@ -189,9 +386,15 @@ def buildSchwabePositions(ndims=1,group_keys=None,group_values=None):
     
     positions_w = {}
     positions_z = {}
+    # Group seeds come from a local generator, thus the global numpy random state is not touched
+    rng = np.random.default_rng(seed) if jitter != 0 else None
     for group_key, group_value in zip(group_keys, group_values):
-        positions_w[group_key] = _createPositions(group_value[0],group_value[1],ndims=ndims, coordinate_system='w') 
-        positions_z[group_key] = _createPositions(group_value[0],group_value[1],ndims=ndims, coordinate_system='z') # Dummy, code needs
+        # Same seed for w and z coordinates, so that jittered positions match
+        group_seed = int(rng.integers(2**31)) if rng is not None else None
+        positions_w[group_key] = _createPositions(group_value[0],group_value[1],ndims=ndims, coordinate_system='w', 
+                                                    grid=grid, jitter=jitter, seed=group_seed, dtype=dtype) 
+        positions_z[group_key] = _createPositions(group_value[0],group_value[1],ndims=ndims, coordinate_system='z', 
+                                                    grid=grid, jitter=jitter, seed=group_seed, dtype=dtype) # Dummy, code needs
     coord_dict={'w_coord':positions_w, 'z_coord':positions_z}
     data_positions={'positions_all':coord_dict}
     return data_positions
@@ -240,7 +443,163 @@ def _newest(path='./',type='connections'):
     # return fullfile
     return filename
 
-def showLatestConnections(path='./',filename=None, hist_from=None, savefigname=''):
+def getConnectionsFilename(results_filename):
+    # Connections file of a single run has the same name with 'connections' in place of 'results'.
+    # Array runs have one connections file for all results files with the same timestamp.
+    connections_filename = results_filename.replace('results', 'connections')
+    if os.path.isfile(connections_filename):
+        return connections_filename
+
+    path = os.path.dirname(results_filename)
+    timestamp = re.search(r'\d{8}_\d{7}', os.path.basename(results_filename))
+    if timestamp is None:
+        return None
+    candidates = [  os.path.join(path, f) for f in os.listdir(path or './') 
+                    if 'connections' in f and timestamp.group(0) in f]
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+def _mapFilesInPool(worker, filenames, worker_args=(), n_workers=None, max_in_flight=None, verbose=True):
+    '''
+    Call worker(filename, *worker_args) for each file in a process pool and yield (file_index, result)
+    in the order the files finish. At most max_in_flight files (default 2 * n_workers) are submitted 
+    at any time, so the memory use stays flat for long file lists. The worker must be a module level
+    function and should return only small results. With n_workers=1 the files are processed here, 
+    without a pool.
+    '''
+    n_files = len(filenames)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+
+    def _progress(n_done):
+        if verbose:
+            print(f'\r{n_done}/{n_files} files done', end='\n' if n_done == n_files else '')
+
+    if n_workers == 1:
+        for file_index, filename in enumerate(filenames):
+            result = worker(filename, *worker_args)
+            _progress(file_index + 1)
+            yield file_index, result
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        file_iterator = enumerate(filenames)
+        in_flight = {}
+        n_done = 0
+        while True:
+            # Top up the queue
+            for file_index, filename in file_iterator:
+                in_flight[executor.submit(worker, filename, *worker_args)] = file_index
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+            done, foo = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_index = in_flight.pop(future)
+                n_done += 1
+                _progress(n_done)
+                yield file_index, future.result()
+
+def _sparseToImage(connection_matrix, image_shape, pooling='max'):
+    '''
+    Downsample connection matrix to at most image_shape (rows, columns) pixels, directly from the nonzero
+    elements of the sparse matrix. Each pixel gets the max ('max') or the sum ('sum') of its block of 
+    matrix elements. Time and memory grow with the number of nonzeros, not with N_pre x N_post.
+    '''
+    connection_matrix = sparse.csr_matrix(connection_matrix)
+    n_rows, n_columns = connection_matrix.shape
+    n_image_rows = max(1, min(n_rows, int(image_shape[0])))
+    n_image_columns = max(1, min(n_columns, int(image_shape[1])))
+
+    # Row index of each nonzero from the csr structure, then pixel index
+    rows = np.repeat(np.arange(n_rows), np.diff(connection_matrix.indptr))
+    image_rows = rows * n_image_rows // n_rows
+    image_columns = connection_matrix.indices.astype(np.int64) * n_image_columns // n_columns
+    pixel_index = image_rows * n_image_columns + image_columns
+
+    if pooling == 'sum':
+        image = np.bincount(pixel_index, weights=connection_matrix.data, minlength=n_image_rows * n_image_columns)
+    elif pooling == 'max':
+        image = np.zeros(n_image_rows * n_image_columns)
+        np.maximum.at(image, pixel_index, connection_matrix.data)
+    else:
+        raise NotImplementedError('Unknown pooling, valid poolings are max and sum')
+
+    return image.reshape(n_image_rows, n_image_columns)
+
+def plotRaster(ax, t, y, ylims=None, max_n_spikes=RASTER_MAX_N_SPIKES, image_shape=None):
+    '''
+    Spike raster to ax, t spike times and y positions or neuron indices. Up to max_n_spikes spikes are drawn
+    as scatter. Above that the spikes are binned to spike count image of image_shape (rows, columns), default 
+    axes size in pixels, which keeps drawing time and vector exports independent of the number of spikes.
+    '''
+    t = np.asarray(t)
+    y = np.asarray(y)
+    if t.size <= max_n_spikes:
+        return ax.scatter(t, y, s=1)
+
+    if image_shape is None:
+        ax_bbox = ax.get_window_extent()
+        image_shape = (ax_bbox.height, ax_bbox.width)
+    n_image_rows = max(1, int(image_shape[0]))
+    n_image_columns = max(1, int(image_shape[1]))
+    if ylims is None:
+        ylims = (y.min(), y.max())
+    t_range = (t.min(), t.max())
+
+    spike_counts, t_edges, y_edges = np.histogram2d(t, y, bins=(n_image_columns, n_image_rows), range=[t_range, ylims])
+    im = ax.imshow( spike_counts.T, cmap='Greys', origin='lower', aspect='auto', interpolation='nearest',
+                    extent=(t_edges[0], t_edges[-1], y_edges[0], y_edges[-1]))
+    return im
+
+def _decimateTraces(t, y, max_n_points=TRACE_MAX_N_POINTS):
+    '''
+    Min/max envelope of traces y [time, traces] sampled at t, reduced to at most max_n_points points
+    per trace. Time is divided to max_n_points // 2 bins and the minimum and maximum of each bin are 
+    kept in their original order, so peaks and spikes survive decimation. All traces are handled in 
+    one pass. Returns t and y, t being [points, traces] when decimated.
+    '''
+    t = np.asarray(t)
+    y = np.asarray(y)
+    if y.ndim == 1:
+        y = y[:, np.newaxis]
+    n_samples, n_traces = y.shape
+    n_bins = max(1, max_n_points // 2)
+    if n_samples <= max_n_points:
+        return t, y
+
+    bin_size = int(np.ceil(n_samples / n_bins))
+    n_bins = int(np.ceil(n_samples / bin_size))
+    # Pad the last bin with the last sample, it does not change the min or max
+    n_padding = n_bins * bin_size - n_samples
+    y_binned = np.pad(y, ((0, n_padding), (0, 0)), mode='edge').reshape(n_bins, bin_size, n_traces)
+
+    bin_starts = (np.arange(n_bins) * bin_size)[:, np.newaxis]
+    min_indices = np.argmin(y_binned, axis=1) + bin_starts
+    max_indices = np.argmax(y_binned, axis=1) + bin_starts
+    # [bins, 2, traces] -> [2 * bins, traces] in time order
+    indices = np.sort(np.stack((min_indices, max_indices), axis=1), axis=1).reshape(2 * n_bins, n_traces)
+    np.minimum(indices, n_samples - 1, out=indices)
+
+    return t[indices], np.take_along_axis(y, indices, axis=0)
+
+def plotTraces(ax, t, y, max_n_points=TRACE_MAX_N_POINTS):
+    '''
+    Plot traces y [time, traces] against t to ax, decimated to min/max envelopes of max_n_points points
+    when longer, see _decimateTraces.
+    '''
+    t_decimated, y_decimated = _decimateTraces(t, y, max_n_points=max_n_points)
+    return ax.plot(t_decimated, y_decimated)
+
+def showLatestConnections(path='./',filename=None, hist_from=None, savefigname='', image_shape=None, pooling='max'):
+    '''
+    Show connection matrices and weight histogram. Matrices larger than image_shape (default size of 
+    the axes in pixels) are downsampled by pooling ('max' or 'sum') over blocks of neurons.
+    '''
 
     filename = parsePath(path,filename, type='connections')
     
@@ -262,18 +621,27 @@ def showLatestConnections(path='./',filename=None, hist_from=None, savefigname='
     fig, axs = plt.subplots(n_rows, n_columns)
     axs = axs.flat
     for ax, connection in zip(axs,list_of_connections):
-        im = ax.imshow(data[connection]['data'].todense())
+        if image_shape is None:
+            ax_bbox = ax.get_window_extent()
+            this_image_shape = (ax_bbox.height, ax_bbox.width)
+        else:
+            this_image_shape = image_shape
+        connection_matrix = data[connection]['data']
+        n_pre, n_post = connection_matrix.shape
+        image = _sparseToImage(connection_matrix, this_image_shape, pooling=pooling)
+        im = ax.imshow(image, extent=(-0.5, n_post - 0.5, n_pre - 0.5, -0.5), interpolation='nearest')
         ax.set_title(connection, fontsize=10)
         fig.colorbar(im, ax=ax)
-    data4hist = np.squeeze(np.asarray(data[hist_from]['data'].todense().flatten()))
-    data4hist_nozeros = np.ma.masked_equal(data4hist,0)
+    # Histogram from the nonzero weights only
+    data4hist = sparse.csr_matrix(data[hist_from]['data']).data
+    data4hist_nozeros = data4hist[data4hist != 0]
     axs[(n_rows * n_columns)-1].hist(data4hist_nozeros)
     if savefigname:
         figsave(figurename=savefigname)
 
     plt.show()
 
-def showLatestVm(path='./',filename=None, savefigname=''):
+def showLatestVm(path='./',filename=None, savefigname='', max_n_points=TRACE_MAX_N_POINTS):
 
     filename = parsePath(path,filename, type='results')
 
@@ -303,12 +671,12 @@ def showLatestVm(path='./',filename=None, savefigname=''):
             # neuron_index_center=data['positions_all']['w_coord'][results].index(0+0j)
             neuron_index_center = _getNeuronIndex(data, results, position=0+0j)
             
-            im = ax.plot(t[time_interval[0]:time_interval[1]], 
+            im = plotTraces(ax, t[time_interval[0]:time_interval[1]], 
                         data['vm_all'][results]['vm'][time_interval[0]:time_interval[1],
-                        neuron_index_center-1:neuron_index_center+2])
+                        neuron_index_center-1:neuron_index_center+2], max_n_points=max_n_points)
         else:
-            im = ax.plot(t[time_interval[0]:time_interval[1]], 
-                        data['vm_all'][results]['vm'][time_interval[0]:time_interval[1],:])
+            im = plotTraces(ax, t[time_interval[0]:time_interval[1]], 
+                        data['vm_all'][results]['vm'][time_interval[0]:time_interval[1],:], max_n_points=max_n_points)
         ax.set_title(results, fontsize=10)
 
     if savefigname:
@@ -316,7 +684,7 @@ def showLatestVm(path='./',filename=None, savefigname=''):
 
     plt.show()
 
-def showLatestG(path='./',filename=None, savefigname=''):
+def showLatestG(path='./',filename=None, savefigname='', max_n_points=TRACE_MAX_N_POINTS):
 
     filename = parsePath(path,filename, type='results')
 
@@ -339,16 +707,16 @@ def showLatestG(path='./',filename=None, savefigname=''):
     axs = axs.flat
 
     for ax, results in zip(axs,list_of_results_ge):
-        im = ax.plot(t[time_interval[0]:time_interval[1]], 
-                     data['ge_soma_all'][results]['ge_soma'][time_interval[0]:time_interval[1],0:-1:20])
+        im = plotTraces(ax, t[time_interval[0]:time_interval[1]], 
+                     data['ge_soma_all'][results]['ge_soma'][time_interval[0]:time_interval[1],0:-1:20], max_n_points=max_n_points)
         ax.set_title(results + ' ge', fontsize=10)
 
     fig2, axs2 = plt.subplots(n_rows, n_columns)
     axs2 = axs2.flat
 
     for ax2, results2 in zip(axs2,list_of_results_gi):
-        im = ax2.plot(t[time_interval[0]:time_interval[1]], 
-                     data['gi_soma_all'][results2]['gi_soma'][time_interval[0]:time_interval[1],0:-1:20])
+        im = plotTraces(ax2, t[time_interval[0]:time_interval[1]], 
+                     data['gi_soma_all'][results2]['gi_soma'][time_interval[0]:time_interval[1],0:-1:20], max_n_points=max_n_points)
         ax2.set_title(results2 + ' gi', fontsize=10)
 
     if savefigname:
@@ -356,7 +724,7 @@ def showLatestG(path='./',filename=None, savefigname=''):
 
     plt.show()
 
-def showLatestI(path='./',filename=None, savefigname=''):
+def showLatestI(path='./',filename=None, savefigname='', max_n_points=TRACE_MAX_N_POINTS):
 
     filename = parsePath(path,filename, type='results')
 
@@ -368,13 +736,7 @@ def showLatestI(path='./',filename=None, savefigname=''):
     list_of_results_gi = [n for n in data['gi_soma_all'].keys() if 'NG' in n]
     list_of_results_vm = [n for n in data['vm_all'].keys() if 'NG' in n]
 
-    El = -65 * mV
-    gl = 50 * nS
-    Ee = 0 * mV
-    Ei = -75 * mV
-
     print(list_of_results_ge)
-    print(f'Assuming El = {El:6.4f} * mV, gl = {gl:6.4f} * nS, Ee = {Ee:6.4f} * mV, Ei = {Ei:6.4f} * mV\nDig from physiology df if u start messing with neuron types')
 
     n_images=len(list_of_results_ge)
     n_columns = 2
@@ -383,33 +745,40 @@ def showLatestI(path='./',filename=None, savefigname=''):
     t=data['ge_soma_all'][list_of_results_ge[0]]['t']
     time_interval=[2000, 4000]
 
+    # Physiology configuration is parsed once for all groups
+    physiology_parameters = None
+    if 'Physiology_configuration' in data:
+        physiology_parameters = getPhysiologyParameters(data['Physiology_configuration'])
+
+    # Currents for all groups, only within time_interval, in amperes
+    currents_dict = getCurrents(data, neuron_groups=list_of_results_vm, time_interval=time_interval, 
+                                physiology_parameters=physiology_parameters)
+
     fig, axs = plt.subplots(n_rows, n_columns)
     axs = axs.flat
 
-    for ax, results_ge, results_gi, results_vm in zip(  axs,list_of_results_ge, \
-                                                        list_of_results_gi,list_of_results_vm):
+    for ax, results_vm in zip(axs, list_of_results_vm):
 
         N_monitored_neurons = data['vm_all'][results_vm]['vm'].shape[1]
         N_neurons = len(data['positions_all']['w_coord'][results_vm])
 
-        ge= data['ge_soma_all'][results_ge]['ge_soma']
-        gi= data['gi_soma_all'][results_gi]['gi_soma']
-        vm= data['vm_all'][results_vm]['vm']
-        I_total = gl * (El - vm) + ge * (Ee - vm) + gi * (Ei - vm)
+        I_total = currents_dict[results_vm]['I_total']
+        parameters = getCurrentParameters(data, results_vm, physiology_parameters=physiology_parameters)
+        print(f"{results_vm}: El = {parameters['El'] * 1e3:6.4f} * mV, gl = {parameters['gl'] * 1e9:6.4f} * nS, " + \
+              f"Ee = {parameters['Ee'] * 1e3:6.4f} * mV, Ei = {parameters['Ei'] * 1e3:6.4f} * mV")
 
         if N_monitored_neurons == N_neurons: 
             # neuron_index_center=data['positions_all']['w_coord'][results_vm].index(0+0j)
             neuron_index_center = _getNeuronIndex(data, results_vm, position=0+0j)
-            ax.plot(t[time_interval[0]:time_interval[1]], 
-                        I_total[time_interval[0]:time_interval[1],
-                        neuron_index_center])
+            plotTraces(ax, t[time_interval[0]:time_interval[1]], 
+                        I_total[:, neuron_index_center], max_n_points=max_n_points)
         else:
-            ax.plot(t[time_interval[0]:time_interval[1]], 
-                        I_total[time_interval[0]:time_interval[1],:])
+            plotTraces(ax, t[time_interval[0]:time_interval[1]], 
+                        I_total, max_n_points=max_n_points)
 
         ax.set_title(results_vm + ' I', fontsize=10)
 
-        I_total_mean = np.mean(I_total[time_interval[0]:time_interval[1]] / namp)
+        I_total_mean = np.mean(I_total) * 1e9 # nA
         I_total_mean_str = f'mean I = {I_total_mean:6.2f} nAmp'
         ax.text(0.05, 0.95, I_total_mean_str, fontsize=10, verticalalignment='top', transform=ax.transAxes)
 
@@ -418,12 +787,9 @@ def showLatestI(path='./',filename=None, savefigname=''):
 
     plt.show()
 
-def _getI(neuron_group,data):
+def _getI(neuron_group,data, physiology_parameters=None):
 
     # Extract connections from data dict
-    # list_of_results_ge = [n for n in data['ge_soma_all'].keys() if 'NG' in n]
-    # list_of_results_gi = [n for n in data['gi_soma_all'].keys() if 'NG' in n]
-    # list_of_results_vm = [n for n in data['vm_all'].keys() if 'NG' in n]
     list_of_results_ge = [n for n in data['ge_soma_all'].keys() if neuron_group in n]
     list_of_results_gi = [n for n in data['gi_soma_all'].keys() if neuron_group in n]
     list_of_results_vm = [n for n in data['vm_all'].keys() if neuron_group in n]
@@ -435,36 +801,110 @@ def _getI(neuron_group,data):
         I_excitatory_mean = 0
         I_inhibitory_mean = 0
         return I_total_mean, I_excitatory_mean, I_inhibitory_mean
-    # These data are available in physiology_configuration file (inside results datafile), but hard coded here for the time being
-    El = -65 * mV
-    gl = 50 * nS
-    Ee = 0 * mV
-    Ei = -75 * mV
 
     time_interval=[2000, 4000]
 
-    for results_ge, results_gi, results_vm in zip(  list_of_results_ge, \
-                                                        list_of_results_gi,list_of_results_vm):
-
-        N_monitored_neurons = data['vm_all'][results_vm]['vm'].shape[1]
-        N_neurons = len(data['positions_all']['w_coord'][results_vm])
-
-        ge= data['ge_soma_all'][results_ge]['ge_soma']
-        gi= data['gi_soma_all'][results_gi]['gi_soma']
-        vm= data['vm_all'][results_vm]['vm']
-        I_total = gl * (El - vm) + ge * (Ee - vm) + gi * (Ei - vm)
-        I_excitatory = ge * (Ee - vm)
-        I_inhibitory = gi * (Ei - vm)
+    # As before, the last matching group gives the result
+    results_vm = list_of_results_vm[-1]
+    currents = getCurrents(data, neuron_groups=[results_vm], time_interval=time_interval, 
+                            physiology_parameters=physiology_parameters)[results_vm]
 
-        if N_monitored_neurons == N_neurons: 
-            neuron_index_center = _getNeuronIndex(data, results_vm, position=0+0j)
-        I_total_mean = np.mean(I_total[time_interval[0]:time_interval[1]] / namp)
-        I_excitatory_mean = np.mean(I_excitatory[time_interval[0]:time_interval[1]] / namp)
-        I_inhibitory_mean = np.mean(I_inhibitory[time_interval[0]:time_interval[1]] / namp)
+    I_total_mean = np.mean(currents['I_total']) * 1e9 # nA
+    I_excitatory_mean = np.mean(currents['I_excitatory']) * 1e9 # nA
+    I_inhibitory_mean = np.mean(currents['I_inhibitory']) * 1e9 # nA
         
     return I_total_mean, I_excitatory_mean, I_inhibitory_mean
 
-def showLatestSpatial(path='./',filename=None,sum_length=1, savefigname=''):
+def getFiringRates( data=None, filename=None, neuron_groups=None, n_time_bins=1, time_range=None, sum_length=1, 
+                    space_bins=None, coords='w_coord', use_cache=True):
+    '''
+    Binned spike counts and firing rates for neuron groups (default all groups in spikes_all), in one bincount 
+    pass over the spikes of each group. 
+    
+    Time is divided to n_time_bins over time_range (default 0 to runtime, in seconds). Neurons are binned 
+    either by index, sum_length consecutive neurons together (None for all neurons in one bin), or by
+    position, space_bins being number of bins or bin edges along the real axis of coords.
+
+    Returns dict with one dict for each neuron group:
+        'counts' : spike counts [n_time_bins, n_neuron_bins]
+        'rates' : firing rate per neuron in Hz [n_time_bins, n_neuron_bins]
+        'time_edges' : time bin edges
+        'n_neurons' : number of neurons in each neuron bin
+        'bin_positions' : mean complex position of the neurons in each neuron bin
+
+    If filename is given, the result is cached for this file and bin specification, and data is loaded 
+    only if there is no valid cache.
+    '''
+    if filename is not None and use_cache:
+        bin_specification = repr((neuron_groups, n_time_bins, time_range, sum_length, 
+                                np.asarray(space_bins).tolist() if space_bins is not None else None, coords))
+        bin_hash = hashlib.sha1(bin_specification.encode()).hexdigest()[:12]
+        path, basename = os.path.split(filename)
+        cache_filename = _getCacheFilename(path, f'{os.path.splitext(basename)[0]}_rates_{bin_hash}')
+        rates_dict = _loadCache(cache_filename, source_filenames=[filename])
+        if rates_dict is not None:
+            return rates_dict
+    if data is None:
+        data = getData(filename)
+
+    if neuron_groups is None:
+        neuron_groups = [n for n in data['spikes_all'].keys() if 'NG' in n]
+    if time_range is None:
+        time_range = (0, float(np.asarray(data['runtime'])))
+    time_start, time_end = time_range
+    time_edges = np.linspace(time_start, time_end, n_time_bins + 1)
+    time_bin_width = (time_end - time_start) / n_time_bins
+
+    rates_dict = {}
+    for neuron_group in neuron_groups:
+        positions = np.asarray(data['positions_all'][coords][neuron_group])
+        n_neurons_in_group = len(positions)
+
+        # Neuron bin for each neuron
+        if space_bins is not None:
+            if np.isscalar(space_bins):
+                space_edges = np.linspace(np.real(positions).min(), np.real(positions).max(), int(space_bins) + 1)
+            else:
+                space_edges = np.asarray(space_bins)
+            n_neuron_bins = len(space_edges) - 1
+            neuron_bins = np.clip(np.searchsorted(space_edges, np.real(positions), side='right') - 1, 0, n_neuron_bins - 1)
+        else:
+            bin_length = n_neurons_in_group if sum_length is None else sum_length
+            n_neuron_bins = int(np.ceil(n_neurons_in_group / bin_length))
+            neuron_bins = np.arange(n_neurons_in_group) // bin_length
+        n_neurons = np.bincount(neuron_bins, minlength=n_neuron_bins)
+        bin_positions = (np.bincount(neuron_bins, weights=np.real(positions), minlength=n_neuron_bins) + 
+                        1j * np.bincount(neuron_bins, weights=np.imag(positions), minlength=n_neuron_bins)) / np.maximum(n_neurons, 1)
+
+        # Time bin for each spike. Last bin includes the end time, as in np.histogram
+        t = np.asarray(data['spikes_all'][neuron_group]['t'], dtype=float)
+        i = np.asarray(data['spikes_all'][neuron_group]['i'])
+        valid = (t >= time_start) & (t <= time_end)
+        time_bins = np.minimum(((t[valid] - time_start) / time_bin_width).astype(np.int64), n_time_bins - 1)
+
+        counts = np.bincount(   time_bins * n_neuron_bins + neuron_bins[i[valid]], 
+                                minlength=n_time_bins * n_neuron_bins).reshape(n_time_bins, n_neuron_bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rates = counts / (n_neurons * time_bin_width)
+
+        rates_dict[neuron_group] = {
+            'counts' : counts,
+            'rates' : rates,
+            'time_edges' : time_edges,
+            'n_neurons' : n_neurons,
+            'bin_positions' : bin_positions
+            }
+
+    if filename is not None and use_cache:
+        _saveCache(cache_filename, rates_dict)
+
+    return rates_dict
+
+def showLatestSpatial(path='./',filename=None,sum_length=1, savefigname='', max_n_spikes=RASTER_MAX_N_SPIKES):
+    '''
+    Show spikes along position and firing frequency summed over sum_length neurons. Groups with more 
+    than max_n_spikes spikes are shown as spike count image, see plotRaster.
+    '''
 
     filename = parsePath(path,filename, type='results')
 
@@ -491,31 +931,19 @@ def showLatestSpatial(path='./',filename=None,sum_length=1, savefigname=''):
     for ax1, results in zip(axs[0:-1:2],list_of_results):
         # im = ax1.scatter(data['spikes_all'][results]['t'], data['spikes_all'][results]['i'],s=1)
         position_idxs=data['spikes_all'][results]['i']
-        im = ax1.scatter(   data['spikes_all'][results]['t'], 
-                            np.real(data['positions_all'][coords][results])[position_idxs],
-                            s=1)
+        im = plotRaster(ax1, data['spikes_all'][results]['t'], 
+                        np.real(data['positions_all'][coords][results])[position_idxs],
+                        ylims=ylims, max_n_spikes=max_n_spikes)
         ax1.set_ylim(ylims)
         ax1.set_title(results, fontsize=10)
     # Summary histograms
+    #Sum neurons in sum_length bin width
+    if sum_length is None:
+        sum_length = 3 # How many neurons to sum together
+    rates_dict = getFiringRates(data=data, filename=filename, neuron_groups=list_of_results, sum_length=sum_length, coords=coords)
     for ax2, results in zip(axs[1:-1:2],list_of_results):
-        # position_idxs=data['spikes_all'][results]['i']
-        #Rearrange and sum neurons in sum_length bin width
-        if sum_length is None:
-            sum_length = 3 # How many neurons to sum together
-        full_vector=data['spikes_all'][results]['count'].astype('float64')
-        necessary_length = int(np.ceil(len(full_vector)/sum_length)) * sum_length
-        n_zeros = necessary_length - len(full_vector)
-        full_vector_padded = np.pad(full_vector, (0, n_zeros), 'constant', constant_values=(np.NaN, np.NaN))
-        rearranged_data = np.reshape(full_vector_padded,[sum_length, int(necessary_length/sum_length) ], order='F')
-        summed_rearranged_data = np.nansum(rearranged_data, axis=0)
-        full_vector_pos = np.real(data['positions_all'][coords][results])
-        full_vector_pos_padded = np.pad(full_vector_pos, (0, n_zeros), 'constant', constant_values=(np.NaN, np.NaN))
-        rearranged_pos = np.reshape(full_vector_pos_padded,[sum_length, int(necessary_length/sum_length) ], order='F')
-        mean_rearranged_pos = np. nanmean(rearranged_pos, axis=0)
-
-        firing_frequency = summed_rearranged_data / (sum_length * data['runtime'])
-
-        pos = mean_rearranged_pos
+        firing_frequency = rates_dict[results]['rates'][0,:]
+        pos = np.real(rates_dict[results]['bin_positions'])
         im = ax2.barh(pos, firing_frequency, height=1.0)
         ax2.set_ylim(ylims)
         # ax2.axes.get_yaxis().set_visible(False)
@@ -529,6 +957,75 @@ def showLatestSpatial(path='./',filename=None,sum_length=1, savefigname=''):
 
     plt.show()
 
+def _welchPSD(vm, fs, n_segments=8, overlap=0.5, max_chunk_size=2**24):
+    # Welch PSD along time (axis 0) for each neuron (columns) of float array vm. Segment length as in 
+    # elephant.spectral.welch_psd with n_segments. Neurons are processed in chunks of at most 
+    # max_chunk_size elements to keep the FFT buffers small. Returns freqs and psd [n_neurons, n_freqs].
+    n_samples, n_neurons = vm.shape
+    len_segment = int(2 * n_samples / (n_segments + 1))
+    noverlap = int(len_segment * overlap)
+    n_neurons_per_chunk = max(1, int(max_chunk_size // n_samples))
+    psd = None
+    for chunk_start in range(0, n_neurons, n_neurons_per_chunk):
+        vm_chunk = vm[:, chunk_start:chunk_start + n_neurons_per_chunk]
+        freqs, psd_chunk = welch(vm_chunk, fs=fs, window='hann', nperseg=len_segment, noverlap=noverlap, 
+                                detrend='constant', scaling='density', axis=0)
+        if psd is None:
+            psd = np.empty((n_neurons, len(freqs)))
+        psd[chunk_start:chunk_start + psd_chunk.shape[1], :] = psd_chunk.T
+    return freqs, psd
+
+def getPSD( data=None, filename=None, neuron_groups=None, n_segments=8, freq_max=None, max_chunk_size=2**24, 
+            n_workers=None, use_cache=True):
+    '''
+    Welch power spectral densities of vm for neuron groups (default all groups in vm_all). Works on plain
+    float arrays, values in SI units. The sampling rate is read from the vm time vector. 
+    Groups are run in a thread pool of n_workers. Frequencies above freq_max are dropped.
+
+    Returns dict with {'freqs': freqs, 'psd': psd [n_neurons, n_freqs]} for each group with vm. 
+    If filename is given, PSDs are cached per file, group and parameters, and data is loaded only if some 
+    of the groups are not cached.
+    '''
+    parameter_hash = hashlib.sha1(repr((n_segments, freq_max)).encode()).hexdigest()[:12]
+    psd_dict = {}
+
+    def _psdCacheFilename(neuron_group):
+        path, basename = os.path.split(filename)
+        return _getCacheFilename(path, f'{os.path.splitext(basename)[0]}_psd_{neuron_group}_{parameter_hash}')
+
+    if filename is not None and use_cache and neuron_groups is not None:
+        for neuron_group in neuron_groups:
+            group_psd = _loadCache(_psdCacheFilename(neuron_group), source_filenames=[filename])
+            if group_psd is not None:
+                psd_dict[neuron_group] = group_psd
+    if data is None:
+        if neuron_groups is not None and all(g in psd_dict for g in neuron_groups):
+            return psd_dict
+        data = getData(filename)
+
+    if neuron_groups is None:
+        neuron_groups = [n for n in data['vm_all'].keys() if 'NG' in n]
+    groups_to_compute = [g for g in neuron_groups if g in data['vm_all'] and g not in psd_dict]
+
+    def _groupPSD(neuron_group):
+        vm = np.asarray(data['vm_all'][neuron_group]['vm'], dtype=float)
+        t = np.asarray(data['vm_all'][neuron_group]['t'], dtype=float)
+        fs = (len(t) - 1) / (t[-1] - t[0])
+        freqs, psd = _welchPSD(vm, fs, n_segments=n_segments, max_chunk_size=max_chunk_size)
+        if freq_max is not None:
+            psd = psd[:, freqs < freq_max]
+            freqs = freqs[freqs < freq_max]
+        return {'freqs' : freqs, 'psd' : psd}
+
+    # FFTs release the GIL, thus threads run in parallel and share the data without copying
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for neuron_group, group_psd in zip(groups_to_compute, executor.map(_groupPSD, groups_to_compute)):
+            psd_dict[neuron_group] = group_psd
+            if filename is not None and use_cache:
+                _saveCache(_psdCacheFilename(neuron_group), group_psd)
+
+    return psd_dict
+
 def showLatestSpectra(path='./',filename=None, savefigname=''):
 
     filename = parsePath(path,filename, type='results')
@@ -556,25 +1053,23 @@ def showLatestSpectra(path='./',filename=None, savefigname=''):
     fig, axs = plt.subplots(n_rows * 2, n_columns, gridspec_kw={'width_ratios': width_ratios})
     axs = axs.flat
 
+    # Population firing rates, all neurons in one bin
+    rates_dict = getFiringRates( data=data, filename=filename, neuron_groups=list_of_results, n_time_bins=nbins, 
+                                time_range=(0, duration), sum_length=None)
     for ax1, results in zip(axs[0:-1:2],list_of_results):
         # im = ax1.scatter(data['spikes_all'][results]['t'], data['spikes_all'][results]['i'],s=1)
-        counts, bins = np.histogram(data['spikes_all'][results]['t']/second, range=[0,duration], bins=nbins)
-        Nneurons = data['number_of_neurons'][results]
-        firing_rates = counts * (nbins / (duration * Nneurons))
+        firing_rates = rates_dict[results]['rates'][:,0]
+        bins = rates_dict[results]['time_edges']
         im = ax1.bar(bins[:-1], firing_rates, width=bar_width)
         ax1.set_title(results, fontsize=10)
 
+    # Vm spectra, only for groups with monitored vm
+    psd_dict = getPSD(data=data, filename=filename, neuron_groups=list_of_results, freq_max=freqCutoff)
     for ax2, results in zip(axs[1:-1:2],list_of_results):
-        try:
-            Vms=data['vm_all'][results]['vm']
-        except:
+        if results not in psd_dict:
             continue
-        sigarr = AnalogSignal(Vms, units='mV', sampling_rate=10000*pq.Hz)
-        freqs, psd = el.spectral.welch_psd(sigarr, n_segments=8, len_segment=None, frequency_resolution=None, fs=10000, nfft=None, scaling='density', axis=- 1)
-        
-        # Cut to desired freq range
-        freqs_for_plotting = freqs[freqs < freqCutoff]
-        psd_for_plotting = psd[:,freqs < freqCutoff]
+        freqs_for_plotting = psd_dict[results]['freqs']
+        psd_for_plotting = psd_dict[results]['psd']
 
         # Calculate mean psd
         psd_for_plotting_mean = np.mean(psd_for_plotting, axis=0)
@@ -591,12 +1086,49 @@ def showLatestSpectra(path='./',filename=None, savefigname=''):
 
     plt.show()
 
-def showLatestASF(path='./',timestamp=None,sum_length=1, fixed_y_scale=True, data_type='spikes', savefigname=''):
+def _getASFValues(filename, list_of_results, sum_length, data_type, epoch_duration):
     '''
-    Show ASF curves for single value or for an array search across one independent variable.
+    Worker for showLatestASF. Loads one result file and returns, for each neuron group, the firing
+    frequency of the sum_length neurons at the center or the mean total, excitatory and 
+    inhibitory currents. Inhibitory currents are inverted to positive.
+    '''
+    data = getData(filename)
+    ASF_values = {}
+    if data_type == 'spikes':
+        # Spike counts for each neuron over the whole run
+        rates_dict = getFiringRates(data=data, neuron_groups=list_of_results, sum_length=1)
+    elif data_type == 'current' and 'Physiology_configuration' in data:
+        # Parsed once for all groups
+        physiology_parameters = getPhysiologyParameters(data['Physiology_configuration'])
+    else:
+        physiology_parameters = None
+    for neuron_group in list_of_results:
+        if data_type == 'spikes':
+            # Pick center idx
+            center_index = _getNeuronIndex(data, neuron_group, position=0+0j)
+            neuron_indices = np.arange(center_index - np.floor(sum_length/2), center_index + np.ceil(sum_length/2)).astype('int')
+            full_vector = rates_dict[neuron_group]['counts'][0,:].astype('float64')
+            ASF_values[neuron_group] = np.mean(full_vector[neuron_indices]) / epoch_duration
+        elif data_type == 'current':
+            I_total_mean, I_excitatory_mean, I_inhibitory_mean = _getI(neuron_group, data, physiology_parameters=physiology_parameters)
+            ASF_values[neuron_group] = np.array([I_total_mean, I_excitatory_mean, I_inhibitory_mean * -1])
+
+    return ASF_values
+
+def computeASF(path='./',timestamp=None,sum_length=1, data_type='spikes', n_workers=None, max_in_flight=None, use_cache=True):
+    '''
+    Compute ASF curves for single value or for an array search across one independent variable, without plotting.
     At the moment, no more than 1000 values are adviced for one search,
     e.g. with 20 trials per run and 10 ASF sized this means 5 values for the array of independent variable.
-    Dimensions are (ASF_size, search_variable, trial)
+    Dimensions are (ASF_size, search_variable, trial), and for currents the fourth dimension is 
+    (I_total_mean, I_excitatory_mean, I_inhibitory_mean).
+    The result files are read in a process pool of n_workers (default all cpus, 1 runs in this process), 
+    with no more than max_in_flight files (default 2 * n_workers) loaded at any time.
+
+    Returns ASF_cube dict with the ASF arrays for each neuron group under 'ASF' and the axis values under
+    'ASF_size' and 'search_variable'. The cube is cached to path/cache, keyed by timestamp, data_type, 
+    sum_length and the size and mtime of the result files, and reloaded from there unless the metadata file 
+    is newer or use_cache is False.
     '''
     
     assert data_type=='spikes' or data_type=='current', "Unknown data type, should be 'spikes' or 'current', aborting"
@@ -620,6 +1152,16 @@ def showLatestASF(path='./',timestamp=None,sum_length=1, fixed_y_scale=True, dat
     metadata_file = [files for files in files_correct_timestamp if 'metadata' in files]
     assert len(metadata_file)<=1, "Multiple metadatafiles, don't know what to do, aborting"
     assert len(metadata_file)==1, "No metadatafile, cannot do ASF from single file, or from different runs"
+    # Rewritten or added result files change the key, thus the cube is not reloaded for them
+    result_files_stats = [(f, os.path.getsize(os.path.join(path, f)), os.path.getmtime(os.path.join(path, f))) 
+                            for f in sorted(result_files_for_ASF)]
+    result_files_hash = hashlib.sha1(repr(result_files_stats).encode()).hexdigest()[:12]
+    cache_filename = _getCacheFilename(path, f'ASF_{timestamp}_{data_type}_sum{sum_length}_{result_files_hash}')
+    if use_cache:
+        ASF_cube = _loadCache(cache_filename, source_filenames=[os.path.join(path, metadata_file[0])])
+        if ASF_cube is not None:
+            return ASF_cube
+
     metadata_df=getData(os.path.join(path, metadata_file[0]))
 
     # Test if multiple trials per run and one or two dimensions (first is always ASF size)
@@ -692,40 +1234,20 @@ def showLatestASF(path='./',timestamp=None,sum_length=1, fixed_y_scale=True, dat
     elif data_type == 'current':
         ASF_dict = {k:np.zeros([ASF_array_length,search_variable_array_length, trials_per_config, 3]) for k in list_of_results}
 
-    # Loop for data
-    trial = 0
-    search_variable = 0
-    ASF_size = 0
-
     epoch_duration = np.max(data['time_vector']) - np.min(data['time_vector'])
-
-    # for filename in filename_dict_sorted:
-    for filename in filename_array_sorted:
-        data = getData(filename)
-        # print(f'I am happy for data {filename}')
-        # For each neuron group, get spike frequencies for neurons of interest, accept sum_length
+    del data
+
+    # Extract the per-group values in a process pool. Each worker loads one file and returns only 
+    # the few scalars needed here, so the full data dicts never pile up in this process.
+    # The file order is (ASF_size, search_variable, trial), trial running fastest.
+    worker_args = (list_of_results, sum_length, data_type, epoch_duration)
+    for file_index, ASF_values in _mapFilesInPool(  _getASFValues, filename_array_sorted, worker_args=worker_args, 
+                                                    n_workers=n_workers, max_in_flight=max_in_flight):
+        trial = file_index % trials_per_config
+        search_variable = (file_index // trials_per_config) % search_variable_array_length
+        ASF_size = file_index // (trials_per_config * search_variable_array_length)
         for neuron_group in list_of_results:
-            # Pick center idx
-            center_index = _getNeuronIndex(data, neuron_group, position=0+0j)
-            neuron_indices = np.arange(center_index - np.floor(sum_length/2), center_index + np.ceil(sum_length/2)).astype('int')
-            
-            # Select data, add to nd array
-            if data_type == 'spikes':
-                full_vector=data['spikes_all'][neuron_group]['count'].astype('float64')
-                firing_frequency = np.mean(full_vector[neuron_indices]) / epoch_duration
-                ASF_dict[neuron_group][ASF_size, search_variable, trial] = firing_frequency
-            elif data_type == 'current':
-                I_total_mean, I_excitatory_mean, I_inhibitory_mean = _getI(neuron_group, data)
-                ASF_dict[neuron_group][ASF_size, search_variable, trial, 0] = I_total_mean
-                ASF_dict[neuron_group][ASF_size, search_variable, trial, 1] = I_excitatory_mean
-                ASF_dict[neuron_group][ASF_size, search_variable, trial, 2] = I_inhibitory_mean *-1 ## Inverting inhibitory currents to positive
-
-
-        trial += 1
-        if trial == trials_per_config: 
-            trial = 0; search_variable += 1
-        if search_variable == search_variable_array_length: 
-            search_variable = 0; ASF_size += 1
+            ASF_dict[neuron_group][ASF_size, search_variable, trial] = ASF_values[neuron_group]
 
     # For ANN data the ANN size is inverted above, resulting in inverting search variable and trial, too.
     # Here, the search variable will be inverted. I also invert the trial number for consistency.
@@ -735,6 +1257,40 @@ def showLatestASF(path='./',timestamp=None,sum_length=1, fixed_y_scale=True, dat
             ASF_dict_inv[neuron_group] = np.flip(ASF_dict[neuron_group], axis=(1,2)) # dim 1 = search variable, dim 2 = trial
         ASF_dict = ASF_dict_inv
 
+    if data_type == 'spikes':
+        labels = ('firing_frequency')
+    elif data_type == 'current':
+        labels = ('I_total_mean', 'I_excitatory_mean','I_inhibitory_mean')
+
+    ASF_cube = {
+        'ASF' : ASF_dict,
+        'dims' : ('ASF_size', 'search_variable', 'trial') + (('current_type',) if data_type == 'current' else ()),
+        'ASF_size' : np.asarray(ASF_x_axis_values),
+        'search_variable' : np.asarray(search_variable_array),
+        'search_variable_name' : search_variable_name,
+        'labels' : labels,
+        'neuron_groups' : list_of_results,
+        'timestamp' : timestamp,
+        'data_type' : data_type,
+        'sum_length' : sum_length
+        }
+    _saveCache(cache_filename, ASF_cube)
+
+    return ASF_cube
+
+def plotASF(ASF_cube, fixed_y_scale=True, savefigname=''):
+    '''
+    Plot ASF curves from the ASF_cube returned by computeASF. One figure for each search variable value.
+    '''
+    # Unpack for plotting
+    ASF_dict = ASF_cube['ASF']
+    ASF_x_axis_values = ASF_cube['ASF_size']
+    search_variable_array = ASF_cube['search_variable']
+    search_variable_array_length = len(search_variable_array)
+    search_variable_name = ASF_cube['search_variable_name']
+    labels = ASF_cube['labels']
+    list_of_results = ASF_cube['neuron_groups']
+
     # Visualize
     n_images=len(list_of_results)
     n_columns = 2
@@ -742,10 +1298,6 @@ def showLatestASF(path='./',timestamp=None,sum_length=1, fixed_y_scale=True, dat
     
     # Enable interactive mode, ie don't block ipython with plt.show()
     plt.ion() 
-    if data_type == 'spikes':
-        labels = ('firing_frequency')
-    elif data_type == 'current':
-        labels = ('I_total_mean', 'I_excitatory_mean','I_inhibitory_mean')
 
     # ASF is defined for center receptive field. I leave here the option to show the
     # spatial dimension in the second subplot, including eg the parameters of DoG fit
@@ -800,6 +1352,17 @@ def showLatestASF(path='./',timestamp=None,sum_length=1, fixed_y_scale=True, dat
 
     plt.show()
 
+def showLatestASF(path='./',timestamp=None,sum_length=1, fixed_y_scale=True, data_type='spikes', savefigname='', 
+                    n_workers=None, max_in_flight=None, use_cache=True):
+    '''
+    Show ASF curves for single value or for an array search across one independent variable.
+    Dimensions are (ASF_size, search_variable, trial). See computeASF for the parameters. 
+    Replotting with another fixed_y_scale or savefigname reads the cached ASF cube.
+    '''
+    ASF_cube = computeASF(  path=path, timestamp=timestamp, sum_length=sum_length, data_type=data_type, 
+                            n_workers=n_workers, max_in_flight=max_in_flight, use_cache=use_cache)
+    plotASF(ASF_cube, fixed_y_scale=fixed_y_scale, savefigname=savefigname)
+
 def createASFset(start_stim_radius=0.1,end_stim_radius=8,units='deg',Nsteps=5,show_positions=True):
     
     M=2.3 # M factor of macaque V1 at 5 deg ecc